@@ -6,9 +6,13 @@
 # To upload every day at noon, add 0 12 * * * /path/to/script/aws_costs_cron.sh
 # to crontab -e.
 # Created by R. Byrne 10/17
+# cost_plotter.py reads the cost reports with boto3 if it is installed in the
+# python below (conda install boto3), and otherwise with the aws command line
+# tools given by AWS_CLI, which cron doesn't have on its PATH. Credentials
+# are set up by aws configure.
 
+export AWS_CLI=/home/rlbyrne/anaconda2/bin/aws
 /home/rlbyrne/anaconda2/bin/python /home/rlbyrne/rlb_aws/cost_plotter.py
 plotname=$(ls /home/rlbyrne/rlb_aws/aws_costs_*.png)
 /home/rlbyrne/slackcat --channel eor_cloud ${plotname}
-rm /home/rlbyrne/rlb_aws/cost_report-1.csv
 rm ${plotname}
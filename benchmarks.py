@@ -0,0 +1,488 @@
+#!/usr/bin/env python
+
+# Benchmarks for the hot paths of the cost plots, HEALPix mosaics and
+# survey tools, run on synthetic data so no S3 access is needed. Inputs
+# (cost reports, partial-sky HEALPix maps and obs info files) are generated
+# deterministically at several sizes, and each benchmark is timed and its
+# peak memory recorded as the input grows. Results are written as JSON, and
+# can be compared against an earlier run to catch regressions before they
+# reach the daily cost cron or the mosaic runs.
+#
+# Usage: benchmarks.py [--output benchmarks.json] [--quick]
+#            [--only cost,healpix,survey] [--compare old.json]
+#
+# Each benchmark case runs in its own worker process so that its peak
+# resident memory (ru_maxrss) isn't inflated by earlier cases. Exits with 1
+# if --compare finds a case more than --tolerance times slower or larger.
+
+import io
+import os
+import sys
+import csv
+import gzip
+import json
+import time
+import shutil
+import socket
+import platform
+import resource
+import tempfile
+import optparse
+import multiprocessing
+from datetime import datetime, timedelta
+import numpy as np
+from astropy.io import fits
+import healpy as hp
+import object_store
+import cost_plotter
+import plot_healpix_aws
+import surveyview
+
+cost_header = [
+    'identity/LineItemId', 'lineItem/UsageStartDate',
+    'lineItem/UsageEndDate', 'lineItem/ProductCode', 'lineItem/UsageType',
+    'lineItem/BlendedCost', 'lineItem/LineItemDescription',
+    'lineItem/ResourceId']
+cost_products = [
+    ('AmazonEC2', 'SpotUsage:c4.8xlarge', '$0.50 per hour, spot', 'i-'),
+    ('AmazonEC2', 'BoxUsage:m4.xlarge', '$0.20 per On Demand hour', 'i-'),
+    ('AmazonEC2', 'EBS:VolumeUsage.gp2', '$0.10 per GB-month', 'vol-'),
+    ('AmazonS3', 'TimedStorage-ByteHrs', '$0.023 per GB-month', 'mwatest'),
+    ('AmazonS3', 'Requests-Tier1', '$0.005 per 1,000 PUT requests',
+     'mwatest'),
+    ('AWSDataTransfer', 'DataTransfer-Out-Bytes', '$0.09 per GB', '')]
+report_month = datetime(2018, 3, 1)
+
+# Diffuse survey-like pointings: dec bands and the (az, el) pairs used in
+# each, at most as many as get_pointings has labels for
+survey_decs = [-55., -40., -27., -13., 2.]
+survey_az_els = [(0., 90.), (90., 75.), (270., 75.), (90., 60.), (270., 60.)]
+
+# Tiles selected from each map, a column of the plot_healpix_tiling grid
+tile_center_ras = [40, 40, 40, 40, 40]
+tile_center_decs = [-5, -15, -25, -35, -45]
+
+
+def open_gzip_text(filename, mode='r'):
+
+    # Gzip file for the csv module, which reads and writes byte strings in
+    # python 2 and text in python 3
+    gzip_file = gzip.open(filename, mode + 'b')
+    if sys.version_info[0] < 3:
+        return gzip_file
+    return io.TextIOWrapper(gzip_file, newline='')
+
+
+def make_cost_report(filename, n_items, n_prices=None,
+                     month_start=report_month, seed=0):
+
+    # Gzipped cost report CSV of n_items hourly line items spread over the
+    # month, for a few hundred resources. With n_prices, instance usage
+    # descriptions carry one of n_prices prices like real spot and on
+    # demand ones do, giving about 2*n_prices distinct descriptions.
+    rng = np.random.RandomState(seed)
+    hours = rng.randint(0, 28*24, n_items)
+    products = rng.randint(0, len(cost_products), n_items)
+    resources = rng.randint(0, 300, n_items)
+    costs = np.where(rng.rand(n_items) < .1, 0., rng.rand(n_items))
+    if n_prices is not None:
+        prices = rng.randint(0, n_prices, n_items)
+    times = [(month_start + timedelta(hours=hour)).strftime(
+        '%Y-%m-%dT%H:%M:%SZ') for hour in range(28*24 + 1)]
+    report_file = open_gzip_text(filename, 'w')
+    writer = csv.writer(report_file)
+    writer.writerow(cost_header)
+    for i in range(n_items):
+        product, usage_type, description, resource = \
+            cost_products[products[i]]
+        if resource.endswith('-'):
+            resource = '{}{:017x}'.format(resource, resources[i])
+            if n_prices is not None and resource.startswith('i-'):
+                description = '${:.4f} per {} hour'.format(
+                    .1 + .0001*prices[i], usage_type.split(':')[-1])
+        writer.writerow([
+            'id{}'.format(i), times[hours[i]], times[hours[i] + 1], product,
+            usage_type, '{:.6f}'.format(costs[i]), description, resource])
+    report_file.close()
+
+
+def make_healpix_map(filename, nside, radius=20., nest=False, seed=0):
+
+    # Partial-sky HEALPix FITS map in the format load_map reads, covering a
+    # disc of radius degrees around the tile column
+    rng = np.random.RandomState(seed)
+    center = hp.ang2vec(40., -25., lonlat=True)
+    pixelnums = hp.query_disc(nside, center, np.radians(radius), nest=nest)
+    signal = rng.normal(0., .01, len(pixelnums)).astype(np.float32)
+    columns = fits.ColDefs([
+        fits.Column(name='PIXEL', format='K', array=pixelnums),
+        fits.Column(name='SIGNAL', format='E', array=signal)])
+    table = fits.BinTableHDU.from_columns(columns)
+    table.header['PIXTYPE'] = 'HEALPIX'
+    table.header['ORDERING'] = 'NESTED' if nest else 'RING'
+    table.header['NSIDE'] = nside
+    table.header['INDXSCHM'] = 'EXPLICIT'
+    table.header['OBJECT'] = 'PARTIAL'
+    fits.HDUList([fits.PrimaryHDU(), table]).writeto(filename, overwrite=True)
+    return len(pixelnums)
+
+
+def make_obs_info(filename, n_obs, seed=0):
+
+    # Obs info file of n_obs observations in the format load_survey reads
+    rng = np.random.RandomState(seed)
+    obsids = 1130000000 + 8*rng.choice(10*n_obs, n_obs, replace=False)
+    bands = rng.randint(0, len(survey_decs), n_obs)
+    pairs = rng.randint(0, len(survey_az_els), n_obs)
+    decs = np.array(survey_decs)[bands] + rng.uniform(-.5, .5, n_obs)
+    ras = rng.uniform(0., 360., n_obs)
+    lsts = rng.uniform(0., 360., n_obs)
+    obs_file = open(filename, 'w')
+    obs_file.write('obsid, lst, ra, dec, az, el\n')
+    for i in range(n_obs):
+        az, el = survey_az_els[pairs[i]]
+        obs_file.write('{}, {:.4f}, {:.4f}, {:.4f}, {:.2f}, {:.2f}\n'.format(
+            obsids[i], lsts[i], ras[i], decs[i], az, el))
+    obs_file.close()
+
+
+def setup_cost_report(work_dir, n_items, n_prices=None):
+
+    # Local stand-in for the billing bucket with one month's report, and the
+    # directory get_data caches it in
+    name = '{}_{}'.format(n_items, n_prices)
+    root = os.path.join(work_dir, 'cost_{}'.format(name))
+    report_dir = os.path.join(root, 'cost_report', '20180301-20180401', 'run')
+    if not os.path.isdir(report_dir):
+        os.makedirs(report_dir)
+        make_cost_report(os.path.join(report_dir, 'cost_report-1.csv.gz'),
+                         n_items, n_prices)
+    return (object_store.LocalStore(root),
+            os.path.join(work_dir, 'cost_cache_{}'.format(name)))
+
+
+def get_report_items(store, cache_dir):
+
+    return cost_plotter.get_data(
+        None, store, report_month, report_month + timedelta(days=28),
+        cache_dir=cache_dir, nprocs=1)
+
+
+def bench_get_data(work_dir, n_items):
+
+    # The cache is cleared before each run so the report is parsed again
+    store, cache_dir = setup_cost_report(work_dir, n_items)
+    return (lambda: get_report_items(store, cache_dir),
+            lambda: shutil.rmtree(cache_dir, ignore_errors=True))
+
+
+def bench_lineitem(work_dir, n_items):
+
+    # The per-line Lineitem parser cost_plotter used before
+    # read_cost_report, on the same report
+    store, cache_dir = setup_cost_report(work_dir, n_items)
+
+    def parse():
+        report_file = open_gzip_text(os.path.join(
+            store.root, 'cost_report', '20180301-20180401', 'run',
+            'cost_report-1.csv.gz'))
+        header = report_file.readline().strip().split(',')
+        items = [Lineitem(line.strip(), header) for line in report_file]
+        report_file.close()
+        return items
+    return parse, None
+
+
+class Lineitem:
+
+    # cost_plotter's original per-row line item, kept as the reference the
+    # columnar parser is measured against
+
+    def __init__(self, data_line, header):
+        data_split = data_line.split(",")
+        self.starttime = datetime.strptime(
+            data_split[header.index("lineItem/UsageStartDate")],
+            "%Y-%m-%dT%H:%M:%SZ")
+        self.endtime = datetime.strptime(
+            data_split[header.index("lineItem/UsageEndDate")],
+            "%Y-%m-%dT%H:%M:%SZ")
+        self.duration = (self.endtime - self.starttime).total_seconds()
+        self.product = data_split[header.index("lineItem/ProductCode")]
+        self.usage_type = data_split[header.index("lineItem/UsageType")]
+        self.cost = float(data_split[header.index("lineItem/BlendedCost")])
+        self.cost_per_minute = self.cost/self.duration*60
+        self.description = data_split[
+            header.index("lineItem/LineItemDescription")]
+
+
+def get_plot_timeline(work_dir, n_items, n_prices=None):
+
+    # What plot_charges does after loading the line items: the rollup and
+    # the per-minute timeline it plots
+    store, cache_dir = setup_cost_report(work_dir, n_items, n_prices)
+    charge_items = get_report_items(store, cache_dir)
+    end_time = report_month + timedelta(days=28)
+
+    def build():
+        rollup = cost_plotter.CostRollup(charge_items, end_time, 28.)
+        return rollup.timeline(('product',), min_cost=1.)
+    return build, None
+
+
+def bench_timeline(work_dir, n_items):
+
+    return get_plot_timeline(work_dir, n_items)
+
+
+def bench_timeline_descriptions(work_dir, n_prices):
+
+    # The same on a report with many descriptions, as real ones have, so
+    # memory growing with the number of groups shows up
+    return get_plot_timeline(work_dir, 100000, n_prices)
+
+
+def get_map_filename(work_dir, nside):
+
+    filename = os.path.join(work_dir, 'map_{}.fits'.format(nside))
+    if not os.path.isfile(filename):
+        make_healpix_map(filename, nside)
+    return filename
+
+
+def bench_load_map(work_dir, nside):
+
+    # Reading the map includes touching its columns, since they are memory
+    # mapped and would otherwise not be read at all
+    filename = get_map_filename(work_dir, nside)
+
+    def load():
+        healpix_map = plot_healpix_aws.load_map(filename)
+        return np.sum(healpix_map.pixelnums), np.sum(healpix_map.signal)
+    return load, None
+
+
+def bench_tile_selection(work_dir, nside):
+
+    healpix_map = plot_healpix_aws.load_map(
+        get_map_filename(work_dir, nside), memmap=False)
+
+    def select():
+        return [plot_healpix_aws.select_tile_pixels(healpix_map, ra, dec)
+                for ra, dec in zip(tile_center_ras, tile_center_decs)]
+    return select, None
+
+
+def bench_pixel_corners(work_dir, nside):
+
+    healpix_map = plot_healpix_aws.load_map(
+        get_map_filename(work_dir, nside), memmap=False)
+    return lambda: plot_healpix_aws.get_pixel_corners(
+        healpix_map.pixelnums, nside, healpix_map.nest), None
+
+
+def bench_rasterize(work_dir, nside):
+
+    # The default raster render of plot_mosaic, whose memory should stay
+    # bounded by its batch size rather than grow with the number of pixels
+    healpix_map = plot_healpix_aws.load_map(
+        get_map_filename(work_dir, nside), memmap=False)
+    return lambda: plot_healpix_aws.rasterize_pixels(
+        healpix_map.pixelnums, healpix_map.signal, nside,
+        healpix_map.nest), None
+
+
+def get_obs_info_filename(work_dir, n_obs):
+
+    filename = os.path.join(work_dir, 'obs_info_{}.txt'.format(n_obs))
+    if not os.path.isfile(filename):
+        make_obs_info(filename, n_obs)
+    return filename
+
+
+def bench_load_survey(work_dir, n_obs):
+
+    filename = get_obs_info_filename(work_dir, n_obs)
+    return lambda: surveyview.load_survey(filename), None
+
+
+def bench_get_pointings(work_dir, n_obs):
+
+    observations = surveyview.load_survey(
+        get_obs_info_filename(work_dir, n_obs))
+    return lambda: surveyview.get_pointings(observations), None
+
+
+# name: (group, setup function, sizes, sizes for --quick, size unit). Setup
+# functions generate the inputs for a size and return the function to time
+# and a function to call before each run (or None).
+benchmarks = [
+    ('get_data', ('cost', bench_get_data, [10000, 100000, 1000000],
+                  [10000, 100000], 'line items')),
+    ('Lineitem', ('cost', bench_lineitem, [10000, 100000], [10000],
+                  'line items')),
+    ('timeline', ('cost', bench_timeline, [10000, 100000, 1000000],
+                  [10000, 100000], 'line items')),
+    ('timeline_descriptions', ('cost', bench_timeline_descriptions,
+                               [10, 100, 1000], [10, 100], 'prices')),
+    ('load_map', ('healpix', bench_load_map, [256, 512, 1024, 2048, 4096],
+                  [256, 1024], 'nside')),
+    ('tile_selection', ('healpix', bench_tile_selection,
+                        [256, 512, 1024, 2048, 4096], [256, 1024], 'nside')),
+    ('get_pixel_corners', ('healpix', bench_pixel_corners,
+                           [256, 512, 1024, 2048], [256, 1024], 'nside')),
+    ('rasterize', ('healpix', bench_rasterize, [256, 512, 1024, 2048, 4096],
+                   [256, 1024], 'nside')),
+    ('load_survey', ('survey', bench_load_survey, [1000, 10000, 100000],
+                     [1000, 10000], 'observations')),
+    ('get_pointings', ('survey', bench_get_pointings, [1000, 10000, 100000],
+                       [1000, 10000], 'observations'))]
+
+
+def get_max_rss():
+
+    # Peak resident memory of this process in bytes (ru_maxrss is in KiB on
+    # Linux and in bytes on macOS)
+    max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == 'darwin':
+        return max_rss
+    return max_rss*1024
+
+
+def prepare_case(args):
+
+    # Generate the inputs for one benchmark at one size, and fill any caches
+    # its setup reads from
+    name, size, work_dir = args
+    dict(benchmarks)[name][1](work_dir, size)
+
+
+def run_case(args):
+
+    # Time one benchmark at one size in a fresh worker process. Used as a
+    # worker function, so takes its arguments as a single tuple.
+    name, size, work_dir, repeat = args
+    setup = dict(benchmarks)[name][1]
+    # The first run isn't timed since it includes one-off costs like lazy
+    # imports, but it counts towards the peak memory. peak_increase is how
+    # far the runs raised the peak above what the setup reached.
+    function, reset = setup(work_dir, size)
+    setup_rss = get_max_rss()
+    times = []
+    for i in range(repeat + 1):
+        if reset is not None:
+            reset()
+        start = time.time()
+        function()
+        times.append(time.time() - start)
+    times = times[1:]
+    max_rss = get_max_rss()
+    return {'benchmark': name, 'size': size, 'times': times,
+            'best': min(times), 'median': float(np.median(times)),
+            'peak_rss': max_rss, 'peak_increase': max_rss - setup_rss}
+
+
+def run_benchmarks(names, work_dir, quick=False, repeat=3):
+
+    results = []
+    for name in names:
+        group, setup, sizes, quick_sizes, unit = dict(benchmarks)[name]
+        for size in quick_sizes if quick else sizes:
+            # The inputs are prepared in a worker of their own, so the
+            # memory used generating them isn't counted against the case
+            pool = multiprocessing.Pool(1, maxtasksperchild=1)
+            try:
+                pool.apply(prepare_case, ((name, size, work_dir),))
+                result = pool.apply(run_case, ((name, size, work_dir,
+                                                repeat),))
+            finally:
+                pool.close()
+                pool.join()
+            result['group'] = group
+            result['unit'] = unit
+            print('{} ({} {}): best {:.3f} s, median {:.3f} s, peak {:.1f} MB '
+                  '(+{:.1f} MB)'.format(
+                      name, size, unit, result['best'], result['median'],
+                      result['peak_rss']/1e6, result['peak_increase']/1e6))
+            sys.stdout.flush()
+            results.append(result)
+    return results
+
+
+def compare_results(results, baseline, tolerance=1.5, min_time=.01,
+                    min_memory=1e6):
+
+    # Cases whose best time or peak memory increase grew by more than
+    # tolerance times since the baseline run. Times under min_time seconds
+    # and memory increases under min_memory bytes are too noisy to compare.
+    old_results = dict([((result['benchmark'], result['size']), result)
+                        for result in baseline['results']])
+    regressions = []
+    for result in results:
+        old = old_results.get((result['benchmark'], result['size']))
+        if old is None:
+            continue
+        for field, minimum in [('best', min_time),
+                               ('peak_increase', min_memory)]:
+            if result[field] > tolerance*max(old[field], minimum):
+                regressions.append((result['benchmark'], result['size'],
+                                    field, old[field], result[field]))
+    return regressions
+
+
+if __name__ == '__main__':
+    o = optparse.OptionParser(usage='%prog [options]')
+    o.add_option('--output', type='str', default='benchmarks.json',
+                 help='JSON file to write the results to [default %default].')
+    o.add_option('--only', type='str',
+                 help='Comma separated groups (cost, healpix, survey) or '
+                      'benchmark names to run [default: all].')
+    o.add_option('--quick', action='store_true',
+                 help='Only run the smaller sizes.')
+    o.add_option('--repeat', type='int', default=3,
+                 help='Timed runs per case [default %default].')
+    o.add_option('--work_dir', type='str',
+                 help='Directory for the generated inputs, kept between runs '
+                      '[default: a temporary directory].')
+    o.add_option('--compare', type='str',
+                 help='Earlier results to check for regressions against.')
+    o.add_option('--tolerance', type='float', default=1.5,
+                 help='Slowdown or memory growth factor that counts as a '
+                      'regression [default %default].')
+    opts, args = o.parse_args(sys.argv[1:])
+
+    names = [name for name, benchmark in benchmarks]
+    if opts.only is not None:
+        only = opts.only.split(',')
+        names = [name for name, benchmark in benchmarks
+                 if name in only or benchmark[0] in only]
+        if len(names) == 0:
+            o.error('No benchmarks match --only {}.'.format(opts.only))
+
+    work_dir = opts.work_dir
+    if work_dir is None:
+        work_dir = tempfile.mkdtemp(prefix='rlb_aws_benchmarks_')
+    elif not os.path.isdir(work_dir):
+        os.makedirs(work_dir)
+    try:
+        results = run_benchmarks(names, work_dir, opts.quick, opts.repeat)
+    finally:
+        if opts.work_dir is None:
+            shutil.rmtree(work_dir)
+
+    output_file = open(opts.output, 'w')
+    json.dump({'run': datetime.utcnow().strftime('%Y-%m-%dT%H:%M:%SZ'),
+               'host': socket.gethostname(),
+               'python': platform.python_version(),
+               'numpy': np.__version__, 'healpy': hp.__version__,
+               'quick': bool(opts.quick), 'repeat': opts.repeat,
+               'results': results}, output_file, indent=1, sort_keys=True)
+    output_file.close()
+
+    if opts.compare is not None:
+        regressions = compare_results(results, json.load(open(opts.compare)),
+                                      opts.tolerance)
+        for name, size, field, old, new in regressions:
+            print('REGRESSION: {} ({}) {} went from {:.4g} to {:.4g}'.format(
+                name, size, field, old, new))
+        if len(regressions) > 0:
+            sys.exit(1)
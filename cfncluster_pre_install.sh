@@ -33,6 +33,7 @@ sudo bash ~/FHD_install/Miniconda2-latest-Linux-x86_64.sh -b #-b runs in batch m
 echo 'export PATH="/home/ubuntu/miniconda2/bin:$PATH"' >> ~/.bashrc
 source ~/.bashrc
 conda install astropy
+conda install boto3  # S3 access for the python scripts (object_store.py)
 conda config --add channels conda-forge
 conda install healpy
 
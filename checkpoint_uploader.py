@@ -0,0 +1,277 @@
+#!/usr/bin/env python
+
+# Checkpoints FHD outputs to S3 while a job runs, replacing
+# fhd_on_aws_backup.sh. Files for the observation are uploaded as they change
+# rather than by an hourly full sync, and a manifest of what has already been
+# uploaded (size, mtime and md5 of each file) means only the changed files
+# are sent. When the instance gets a spot termination notice the remaining
+# changes are flushed most valuable first (logs, then final products, then
+# calibration and metadata, then the large intermediate files), so as much as
+# possible gets out in the two minute window.
+#
+# Usage: checkpoint_uploader.py outdir s3_path version job_id myip obs_id
+#
+# Started in the background by fhd_job_aws.sh. --termination_url and the
+# OBJECT_STORE_ROOT environment variable (see object_store.py) point it at
+# local stand-ins for the instance metadata endpoint and the bucket for
+# testing.
+
+import os
+import sys
+import json
+import time
+import hashlib
+import optparse
+import threading
+from multiprocessing.pool import ThreadPool
+import object_store
+
+try:
+    from urllib2 import urlopen, HTTPError
+except ImportError:
+    from urllib.request import urlopen
+    from urllib.error import HTTPError
+
+termination_url = \
+    'http://169.254.169.254/latest/meta-data/spot/termination-time'
+
+# Upload order on termination, by subdirectory of the FHD output directory.
+# Logs (grid_out and any .txt or .log file) come first and anything not
+# listed here comes last.
+priority_dirs = [
+    ['Healpix', 'output_data', 'output_images', 'deconvolution'],
+    ['calibration', 'metadata']]
+
+
+def get_priority(key):
+
+    # Lower is uploaded first
+    if key.startswith('grid_out/') or key.endswith(('.txt', '.log')):
+        return 0
+    top_dir = key.split('/')[0]
+    for priority, dirs in enumerate(priority_dirs):
+        if top_dir in dirs:
+            return priority + 1
+    return len(priority_dirs) + 1
+
+
+def get_md5(filename, block_size=2**24):
+
+    md5 = hashlib.md5()
+    data_file = open(filename, 'rb')
+    try:
+        block = data_file.read(block_size)
+        while block:
+            md5.update(block)
+            block = data_file.read(block_size)
+    finally:
+        data_file.close()
+    return md5.hexdigest()
+
+
+def termination_notice(url=termination_url, timeout=2.):
+
+    # The metadata endpoint returns 404 until the instance is marked for
+    # termination. An unreachable endpoint is not taken as a notice.
+    try:
+        response = urlopen(url, timeout=timeout)
+    except (HTTPError, IOError, OSError):
+        return False
+    response.close()
+    return True
+
+
+class CheckpointUploader:
+
+    # Uploads changed files under watch_dir whose names contain obs_id to
+    # prefix in store. extra_files maps other local files (e.g. the grid
+    # engine logs) to keys relative to prefix.
+
+    def __init__(self, watch_dir, store, prefix, obs_id='',
+                 manifest_filename=None, extra_files={}, nworkers=8):
+        self.watch_dir = watch_dir
+        self.store = store
+        self.prefix = prefix
+        self.obs_id = obs_id
+        self.manifest_filename = manifest_filename
+        self.extra_files = extra_files
+        self.nworkers = nworkers
+        self.manifest = {}
+        if manifest_filename is not None and os.path.isfile(
+                manifest_filename):
+            self.manifest = json.load(open(manifest_filename))
+
+    def save_manifest(self):
+        if self.manifest_filename is None:
+            return
+        temp_filename = '{}.tmp'.format(self.manifest_filename)
+        manifest_file = open(temp_filename, 'w')
+        json.dump(self.manifest, manifest_file)
+        manifest_file.close()
+        os.rename(temp_filename, self.manifest_filename)
+
+    def get_local_files(self):
+        # Map of key (relative to prefix) to local filename
+        files = {}
+        for dirpath, dirnames, filenames in os.walk(self.watch_dir):
+            for filename in filenames:
+                if self.obs_id in filename:
+                    full_filename = os.path.join(dirpath, filename)
+                    key = os.path.relpath(full_filename, self.watch_dir)
+                    files[key.replace(os.sep, '/')] = full_filename
+        for filename, key in self.extra_files.items():
+            if os.path.isfile(filename):
+                files[key] = filename
+        return files
+
+    def seed(self):
+        # Files that are already in the bucket with the same size, e.g. the
+        # previous run's outputs that fhd_job_aws.sh copies down, count as
+        # uploaded until they change
+        remote_sizes = dict([
+            (info.key[len(self.prefix):], info.size)
+            for info in self.store.list(self.prefix)])
+        for key, filename in self.get_local_files().items():
+            file_stat = os.stat(filename)
+            if key not in self.manifest and \
+                    remote_sizes.get(key) == file_stat.st_size:
+                self.manifest[key] = [
+                    file_stat.st_size, file_stat.st_mtime, None]
+        self.save_manifest()
+
+    def scan(self, settle_time=30.):
+        # Files whose size or mtime differ from the manifest, in upload
+        # order. Files modified in the last settle_time seconds are left for
+        # the next scan since they are probably still being written.
+        changes = []
+        now = time.time()
+        for key, filename in self.get_local_files().items():
+            try:
+                file_stat = os.stat(filename)
+            except OSError:
+                continue
+            uploaded = self.manifest.get(key)
+            if uploaded is not None and uploaded[:2] == [
+                    file_stat.st_size, file_stat.st_mtime]:
+                continue
+            if now - file_stat.st_mtime < settle_time:
+                continue
+            changes.append(
+                (get_priority(key), file_stat.st_size, key, filename))
+        return [change[2:] for change in sorted(changes)]
+
+    def upload(self, changes, stop=None, deadline=None):
+        # Upload (key, filename) pairs, nworkers at a time, skipping files
+        # whose content hash matches the manifest. Uploads not yet started
+        # when stop is set or deadline (a time.time() value) passes are
+        # dropped. Returns the number of files uploaded.
+        def upload_change(change):
+            key, filename = change
+            if (stop is not None and stop.is_set()) or \
+                    (deadline is not None and time.time() > deadline):
+                return key, None, False
+            try:
+                file_stat = os.stat(filename)
+                md5 = get_md5(filename)
+                uploaded = self.manifest.get(key)
+                sent = uploaded is None or uploaded[2] != md5
+                if sent:
+                    object_store.push(self.store, filename,
+                                      self.prefix + key, retries=3)
+            except Exception as error:
+                sys.stderr.write('Checkpointing {} failed: {}\n'.format(
+                    filename, error))
+                return key, None, False
+            return key, [file_stat.st_size, file_stat.st_mtime, md5], sent
+
+        n_uploaded = 0
+        pool = ThreadPool(self.nworkers)
+        try:
+            for key, state, sent in pool.imap_unordered(
+                    upload_change, changes):
+                if state is not None:
+                    self.manifest[key] = state
+                    self.save_manifest()
+                n_uploaded += sent
+        finally:
+            pool.close()
+            pool.join()
+        return n_uploaded
+
+
+def watch_termination(terminated, url=termination_url, poll_interval=5.):
+
+    while not terminated.is_set():
+        if termination_notice(url):
+            terminated.set()
+        else:
+            time.sleep(poll_interval)
+
+
+def run(uploader, url=termination_url, poll_interval=5., scan_interval=300.,
+        settle_time=30., flush_time=100.):
+
+    # Checkpoint every scan_interval seconds until a termination notice, then
+    # flush what is left for at most flush_time seconds and return
+    terminated = threading.Event()
+    watcher = threading.Thread(target=watch_termination,
+                               args=(terminated, url, poll_interval))
+    watcher.daemon = True
+    watcher.start()
+
+    uploader.seed()
+    while not terminated.wait(scan_interval):
+        print('Backup to S3: {}'.format(time.strftime('%Y-%m-%d_%H:%M:%S')))
+        sys.stdout.flush()
+        uploader.upload(uploader.scan(settle_time), stop=terminated)
+
+    deadline = time.time() + flush_time
+    print('Spot instance termination notice sent. Preparing to shut down.')
+    print('SPOT TERMINATION TIME {}'.format(
+        time.strftime('%Y-%m-%d_%H:%M:%S')))
+    sys.stdout.flush()
+    sys.stderr.write('Spot instance termination. Shutting down.\n')
+    changes = uploader.scan(settle_time=0.)
+    n_uploaded = uploader.upload(changes, deadline=deadline)
+    print('Flushed {} of {} changed files to S3.'.format(
+        n_uploaded, len(changes)))
+
+
+if __name__ == '__main__':
+    o = optparse.OptionParser(
+        usage='%prog [options] outdir s3_path version job_id myip obs_id')
+    o.add_option('--termination_url', type='str', default=termination_url,
+                 help='Spot termination time endpoint to poll.')
+    o.add_option('--poll_interval', type='float', default=5.,
+                 help='Seconds between termination checks.')
+    o.add_option('--scan_interval', type='float', default=300.,
+                 help='Seconds between checkpoints.')
+    o.add_option('--settle_time', type='float', default=30.,
+                 help='Only checkpoint files unmodified for this long.')
+    o.add_option('--flush_time', type='float', default=100.,
+                 help='Seconds after a termination notice to keep starting '
+                      'uploads.')
+    o.add_option('--nworkers', type='int', default=8,
+                 help='Concurrent uploads.')
+    o.add_option('--grid_out', type='str',
+                 default=os.path.expanduser('~/grid_out'),
+                 help='Directory of the grid engine logs.')
+    opts, args = o.parse_args(sys.argv[1:])
+    if len(args) != 6:
+        o.error('Expected outdir s3_path version job_id myip obs_id.')
+    outdir, s3_path, version, job_id, myip, obs_id = args
+
+    store, prefix = object_store.split_url(
+        '{}/fhd_{}/'.format(s3_path.rstrip('/'), version))
+    extra_files = {}
+    for stream in ['o', 'e']:
+        log_name = 'fhd_job_aws.sh.{}{}'.format(stream, job_id)
+        extra_files[os.path.join(opts.grid_out, log_name)] = \
+            'grid_out/{}_{}.txt'.format(log_name, myip)
+    uploader = CheckpointUploader(
+        os.path.join(outdir, 'fhd_{}'.format(version)), store, prefix,
+        obs_id=obs_id, extra_files=extra_files, nworkers=opts.nworkers,
+        manifest_filename=os.path.join(
+            outdir, '.checkpoint_fhd_{}_{}.json'.format(version, obs_id)))
+    run(uploader, opts.termination_url, opts.poll_interval,
+        opts.scan_interval, opts.settle_time, opts.flush_time)
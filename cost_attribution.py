@@ -0,0 +1,288 @@
+#!/usr/bin/env python
+
+# Attributes EC2 and S3 spend from the cost reports to the FHD jobs that
+# incurred it, giving the cost of each obsid and each version.
+# Line items for an instance (by resource ID) are shared between the jobs
+# running on it at the time, so an instance-hour with four jobs on it costs
+# each of them a quarter of the hour. Instance time with no job running is
+# reported as idle. All other EC2 and S3 costs (volumes, transfers, storage,
+# requests, the cluster master) are shared first equally between the
+# instances busy at the time and then between the jobs on each instance.
+#
+# Usage: cost_attribution.py [--start 2018-03-01] [--end 2018-04-01]
+#            s3://mwatest/diffuse_survey/fhd_<version>/grid_out/ [...]
+#
+# Job windows and instances come from the grid engine logs read by
+# job_telemetry.py; the logs' times are taken to be UTC like the reports'.
+
+import os
+import sys
+import csv
+import optparse
+from datetime import datetime
+import numpy as np
+import object_store
+import cost_plotter
+import job_telemetry
+
+attributed_products = ['AmazonEC2', 'AmazonS3']
+
+
+def get_accrued_costs(starttimes, endtimes, costs):
+
+    # Cost accrued up to each breakpoint by line items whose costs are spread
+    # uniformly over their usage intervals. The accrued cost is linear
+    # between breakpoints, so np.interp gives it exactly at any time.
+    if len(costs) == 0:
+        return np.zeros(1), np.zeros(1)
+    endtimes = np.maximum(endtimes, starttimes + 1)
+    times = np.unique(np.r_[starttimes, endtimes])
+    rates = costs/(endtimes - starttimes)
+    rate_changes = (
+        np.bincount(np.searchsorted(times, starttimes), weights=rates,
+                    minlength=len(times))
+        - np.bincount(np.searchsorted(times, endtimes), weights=rates,
+                      minlength=len(times)))
+    segment_rates = np.cumsum(rate_changes)[:-1]
+    return times, np.r_[0., np.cumsum(segment_rates*np.diff(times))]
+
+
+def get_open_counts(starts, ends):
+
+    # Breakpoints and the number of [start, end) intervals open between each
+    # pair of consecutive breakpoints
+    times = np.unique(np.r_[starts, ends])
+    changes = (np.bincount(np.searchsorted(times, starts),
+                           minlength=len(times))
+               - np.bincount(np.searchsorted(times, ends),
+                             minlength=len(times)))
+    return times, np.cumsum(changes)[:-1]
+
+
+def attribute_costs(job_starts, job_ends, job_nodes, item_starts, item_ends,
+                    item_costs, item_nodes):
+
+    # Cost of each job from line items assigned to the node (instance) they
+    # ran on (item_nodes >= 0) or shared between all busy nodes
+    # (item_nodes < 0). Times are integer seconds. Returns each job's share
+    # of its node's costs and of the shared costs, the node costs incurred
+    # while no job was running on the node and the shared costs incurred
+    # while no node was busy.
+    #
+    # Every node's timeline is shifted into its own range of one axis
+    # (node*span + time), so a single sorted sweep over the breakpoints of
+    # all nodes finds the number of jobs on each node in every segment
+    # without a loop over nodes or over (job, line item) pairs.
+    t0 = min(np.min(job_starts), np.min(item_starts) if len(item_starts)
+             else np.min(job_starts))
+    span = max(np.max(job_ends), np.max(item_ends) if len(item_ends)
+               else np.max(job_ends)) - t0 + 1
+    job_starts_axis = job_nodes*span + (job_starts - t0)
+    job_ends_axis = job_nodes*span + (job_ends - t0)
+    times, n_jobs = get_open_counts(job_starts_axis, job_ends_axis)
+    busy = n_jobs > 0
+    seg_starts = times[:-1]
+    seg_ends = times[1:]
+
+    # Node costs accrued in each segment
+    direct = item_nodes >= 0
+    direct_times, direct_accrued = get_accrued_costs(
+        item_nodes[direct]*span + (item_starts[direct] - t0),
+        item_nodes[direct]*span + (item_ends[direct] - t0), item_costs[direct])
+    direct_costs = (np.interp(seg_ends, direct_times, direct_accrued)
+                    - np.interp(seg_starts, direct_times, direct_accrued))
+    idle_cost = np.sum(item_costs[direct]) - np.sum(direct_costs[busy])
+
+    # Shared costs split equally between the busy nodes, accrued in each
+    # segment for one busy node
+    busy_starts = seg_starts[busy] % span + t0
+    busy_ends = busy_starts + (seg_ends[busy] - seg_starts[busy])
+    pool_times, pool_accrued = get_accrued_costs(
+        item_starts[~direct], item_ends[~direct], item_costs[~direct])
+    if len(busy_starts) > 0:
+        node_times, n_nodes = get_open_counts(busy_starts, busy_ends)
+    else:
+        node_times, n_nodes = np.zeros(1), np.zeros(0, dtype=int)
+    share_times = np.union1d(pool_times, node_times)
+    share_costs = np.diff(np.interp(share_times, pool_times, pool_accrued))
+    share_nodes = np.zeros(len(share_costs), dtype=int)
+    inside = (share_times[:-1] >= node_times[0]) & \
+        (share_times[:-1] < node_times[-1])
+    share_nodes[inside] = n_nodes[
+        np.searchsorted(node_times, share_times[:-1][inside], 'right') - 1]
+    unshared_cost = np.sum(share_costs[share_nodes == 0])
+    share_accrued = np.r_[0., np.cumsum(np.where(
+        share_nodes > 0, share_costs/np.maximum(share_nodes, 1), 0.))]
+    shared_costs = np.zeros(len(seg_starts))
+    shared_costs[busy] = (
+        np.interp(busy_ends, share_times, share_accrued)
+        - np.interp(busy_starts, share_times, share_accrued))
+
+    # Split each segment between the jobs on its node and sum each job's
+    # segments
+    per_job = np.where(busy, 1./np.maximum(n_jobs, 1), 0.)
+    start_inds = np.searchsorted(times, job_starts_axis)
+    end_inds = np.searchsorted(times, job_ends_axis)
+    job_costs = []
+    for segment_costs in [direct_costs, shared_costs]:
+        accrued = np.r_[0., np.cumsum(segment_costs*per_job)]
+        job_costs.append(accrued[end_inds] - accrued[start_inds])
+    return job_costs[0], job_costs[1], idle_cost, unshared_cost
+
+
+def get_job_windows(jobs):
+
+    # Start and end of each job in integer seconds. Jobs that never logged
+    # an end (e.g. spot terminations) end at their last logged time. Jobs
+    # with no start are dropped.
+    time_fields = list(job_telemetry.time_lines.values())
+    times = np.column_stack([jobs[field] for field in time_fields])
+    last_times = np.max(np.where(np.isfinite(times), times, -np.inf), axis=1)
+    ends = np.where(np.isfinite(jobs['end']), jobs['end'], last_times)
+    use = np.isfinite(jobs['start']) & np.isfinite(ends) & \
+        (ends > jobs['start'])
+    return (jobs[use], jobs['start'][use].astype(np.int64),
+            ends[use].astype(np.int64))
+
+
+def attribute_jobs(jobs, charge_items, start_time, end_time):
+
+    # Per-job cost table and a summary of where the window's EC2 and S3
+    # spend went
+    jobs, job_starts, job_ends = get_job_windows(jobs)
+    window_start = int(cost_plotter.to_timestamp(start_time))
+    window_end = int(cost_plotter.to_timestamp(end_time))
+    in_window = (job_ends > window_start) & (job_starts < window_end)
+    jobs = jobs[in_window]
+    job_starts = np.clip(job_starts[in_window], window_start, window_end)
+    job_ends = np.clip(job_ends[in_window], window_start, window_end)
+
+    # Jobs that logged an instance ID run on that instance; older logs only
+    # have the public IP, which still separates the nodes for sharing costs
+    job_node_names = [
+        instance_id if instance_id else 'ip:{}'.format(ip)
+        for instance_id, ip in zip(jobs['instance_id'], jobs['ip'])]
+    node_names, job_nodes = np.unique(job_node_names, return_inverse=True)
+    node_lookup = dict([(name, node) for node, name in enumerate(node_names)])
+
+    # Clip line items to the window, keeping the cost of the part inside it
+    products = np.array(charge_items.products)
+    product_items = np.in1d(products[charge_items.product_codes],
+                            attributed_products)
+    excluded_cost = np.sum(charge_items.costs[~product_items])
+    items = charge_items.select(product_items)
+    item_starts = np.clip(items.starttimes, window_start, window_end)
+    item_ends = np.clip(items.endtimes, window_start, window_end)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        item_costs = np.where(
+            items.endtimes > items.starttimes,
+            items.costs*(item_ends - item_starts)
+            / (items.endtimes - items.starttimes), items.costs)
+    resource_nodes = np.array(
+        [node_lookup.get(resource, -1) for resource in items.resources],
+        dtype=np.int64)
+    item_nodes = resource_nodes[items.resource_codes] if len(items) else \
+        np.zeros(0, dtype=np.int64)
+
+    instance_costs, shared_costs, idle_cost, unshared_cost = \
+        attribute_costs(job_starts, job_ends, job_nodes.astype(np.int64),
+                        item_starts, item_ends, item_costs, item_nodes)
+
+    summary = {
+        'total': np.sum(item_costs), 'instance': np.sum(instance_costs),
+        'shared': np.sum(shared_costs), 'idle': idle_cost,
+        'no_jobs': unshared_cost, 'excluded': excluded_cost}
+    return jobs, instance_costs, shared_costs, summary
+
+
+def group_costs(keys, costs):
+
+    # Total cost and number of jobs for each distinct key, most expensive
+    # first
+    labels, groups = np.unique(keys, return_inverse=True)
+    totals = np.bincount(groups, weights=costs, minlength=len(labels))
+    counts = np.bincount(groups, minlength=len(labels))
+    order = np.argsort(totals)[::-1]
+    return labels[order], totals[order], counts[order]
+
+
+def write_table(filename, header, rows):
+
+    table_file = open(filename, 'w')
+    writer = csv.writer(table_file)
+    writer.writerow(header)
+    writer.writerows(rows)
+    table_file.close()
+
+
+if __name__ == '__main__':
+    o = optparse.OptionParser(usage='%prog [options] log_location [...]')
+    o.add_option('--start', type='str',
+                 help='Start of the window (YYYY-MM-DD) [default: first '
+                      'job].')
+    o.add_option('--end', type='str',
+                 help='End of the window (YYYY-MM-DD) [default: last job].')
+    o.add_option('--billing', type='str', default='s3://eorbilling',
+                 help='Bucket with the cost reports [default %default].')
+    o.add_option('--cache_dir', type='str',
+                 default=os.path.expanduser('~/cost_cache'),
+                 help='Cache for parsed cost reports [default %default].')
+    o.add_option('--obsid_table', type='str',
+                 help='Write the cost per obsid to this CSV file.')
+    o.add_option('--version_table', type='str',
+                 help='Write the cost per version to this CSV file.')
+    opts, args = o.parse_args(sys.argv[1:])
+    if len(args) == 0:
+        o.error('Specify at least one log location.')
+
+    jobs = job_telemetry.collect_logs(args)
+    job_windows = get_job_windows(jobs)
+    if len(job_windows[0]) == 0:
+        o.error('No timed jobs found in the logs.')
+    if opts.start is not None:
+        start_time = datetime.strptime(opts.start, '%Y-%m-%d')
+    else:
+        start_time = cost_plotter.from_timestamp(np.min(job_windows[1]))
+    if opts.end is not None:
+        end_time = datetime.strptime(opts.end, '%Y-%m-%d')
+    else:
+        end_time = cost_plotter.from_timestamp(np.max(job_windows[2]))
+
+    charge_items = cost_plotter.get_data(
+        None, object_store.get_store(opts.billing), start_time, end_time,
+        cache_dir=opts.cache_dir)
+    jobs, instance_costs, shared_costs, summary = attribute_jobs(
+        jobs, charge_items, start_time, end_time)
+    job_costs = instance_costs + shared_costs
+
+    print('EC2 and S3 from {} to {}: ${:.2f}'.format(
+        start_time, end_time, summary['total']))
+    print('  instances running jobs: ${:.2f}'.format(summary['instance']))
+    print('  shared, while jobs ran: ${:.2f}'.format(summary['shared']))
+    print('  idle instances: ${:.2f}'.format(summary['idle']))
+    print('  shared, no jobs running: ${:.2f}'.format(summary['no_jobs']))
+    print('Other products (not attributed): ${:.2f}'.format(
+        summary['excluded']))
+
+    versions = jobs['version']
+    version_rows = []
+    print('\nCost per version:')
+    for version, total, n_jobs in zip(*group_costs(versions, job_costs)):
+        n_obs = len(np.unique(jobs['obsid'][versions == version]))
+        version_rows.append((version, '{:.4f}'.format(total), n_jobs, n_obs,
+                             '{:.4f}'.format(total/n_obs)))
+        print('  {}: ${:.2f} for {} jobs on {} obsids (${:.2f}/obsid)'.format(
+            version, total, n_jobs, n_obs, total/n_obs))
+    obsid_rows = [
+        (obsid, '{:.4f}'.format(total), n_jobs) for obsid, total, n_jobs in
+        zip(*group_costs(jobs['obsid'], job_costs))]
+    print('\nMost expensive obsids:')
+    for obsid, total, n_jobs in obsid_rows[:10]:
+        print('  {}: ${} over {} jobs'.format(obsid, total, n_jobs))
+
+    if opts.version_table is not None:
+        write_table(opts.version_table,
+                    ['version', 'cost', 'jobs', 'obsids', 'cost_per_obsid'],
+                    version_rows)
+    if opts.obsid_table is not None:
+        write_table(opts.obsid_table, ['obsid', 'cost', 'jobs'], obsid_rows)
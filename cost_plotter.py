@@ -7,79 +7,69 @@
 # Created by R. Byrne 10/17
 
 import os
+import sys
+import csv
+import zlib
+import hashlib
+import array
+import multiprocessing
 from datetime import datetime, timedelta
 import numpy as np
 import matplotlib
 matplotlib.use('Agg')
 import matplotlib.pyplot as plt
+import object_store
 
 months = ['January', 'February', 'March', 'April', 'May', 'June', 'July',
           'August', 'September', 'October', 'November', 'December']
+epoch = datetime(1970, 1, 1)
 
 
-def plot_charges():
+def plot_charges(resolution=1, group_by=('product',)):
 
     integrate = True
     path = '/home/rlbyrne/rlb_aws'
-    anaconda_path = '/home/rlbyrne/anaconda2/bin'
     # path = '/Users/ruby/EoR/rlb_aws'
-    # anaconda_path = '/Users/ruby/anaconda/bin/python'
+    store = object_store.get_store('s3://eorbilling')
     plot_days = 32.  # plot up to the last 32 days of data
 
-    charge_items = get_data(path, anaconda_path, plot_days, datetime.now())
-
-    # Get last month's cost data if it is near the beginning of the month
-    #if datetime.now().day <= plot_days:
-    #    charge_items.extend(
-    #        get_data(path, anaconda_path, plot_days,
-    #                 datetime.now() + timedelta(days=-(datetime.now().day+1)))
-    #        )
-
-    total_cost = sum([item.cost for item in charge_items])
-    product_types = list(set([item.product for item in charge_items]))
-    times = [datetime.now() + timedelta(minutes=minutes) for minutes in
-             range(-46080, 0)]
-    while times[-1] > max([item.endtime for item in charge_items]):
-        del times[-1]
-    while times[0] < min([item.starttime for item in charge_items]):
-        del times[0]
-    costs = np.zeros((len(product_types), len(times)))
-    for i, time in enumerate(times):
-        for item in charge_items:
-            if item.starttime < time < item.endtime:
-                costs[product_types.index(item.product), i] += \
-                    item.cost_per_minute
-
-    cost_integrated = np.zeros((len(product_types), len(times)))
-    for j in range(len(product_types)):
-        cost_integrated[j, :] = [sum(costs[j, :i]) for i in range(len(times))]
-
-    # Sort products from most to least expensive. This is horrible and ugly,
-    # make it better.
-    product_types = sorted(
-        product_types, key=lambda val:
-        cost_integrated[product_types. index(val), -1], reverse=True)
+    # Includes last month's cost data if it is near the beginning of the month
+    charge_items = get_data(
+        path, store, datetime.now() - timedelta(days=plot_days),
+        datetime.now())
+
+    # Only the plotted dimensions are rolled up: reports have hundreds of
+    # descriptions, and a cube of every group at minute resolution would
+    # take gigabytes
+    rollup = CostRollup(
+        charge_items, datetime.now(), plot_days, resolution, group_by)
 
     if integrate:
-        cost_integrated_sorted = cost_integrated[
-            cost_integrated[:, -1].argsort()[::-1]
-            ]
-        # Don't plot products that cost less than $1
-        while cost_integrated_sorted[-1, -1] < 1.:
-            cost_integrated_sorted = cost_integrated_sorted[:-1, :]
-            product_types = product_types[:-1]
-        plot_fill_in(
-            times, cost_integrated_sorted, product_types, integrate, path)
+        plot_fill_in(rollup, group_by, integrate, path)
     else:
-        costs_sorted = costs[cost_integrated[:, -1].argsort()[::-1]]
-        plot_lines(times, costs_sorted, product_types, integrate, path)
+        plot_lines(rollup, group_by, integrate, path)
+
+
+def to_timestamp(time):
+
+    return (time - epoch).total_seconds()
+
 
+def from_timestamp(timestamp):
 
-def plot_lines(times, cost_data, product_types, integrate, path):
+    return epoch + timedelta(seconds=float(timestamp))
 
+
+def plot_lines(rollup, group_by, integrate, path):
+
+    labels, times, costs, cost_integrated = rollup.timeline(group_by)
+    if integrate:
+        cost_data = cost_integrated
+    else:
+        cost_data = costs
     plt.plot(times, np.sum(cost_data, axis=0), label='Total')
-    for j in range(len(product_types)):
-        plt.plot(times, cost_data[j, :], label=product_types[j])
+    for j in range(len(labels)):
+        plt.plot(times, cost_data[j, :], label=format_label(labels[j]))
     plt.xlabel("time")
     if integrate:
         plt.ylabel("total cost (USD)")
@@ -91,16 +81,24 @@ def plot_lines(times, cost_data, product_types, integrate, path):
     plt.savefig('{}/aws_costs_{}.png'.format(path, datetime.now().date()))
 
 
-def plot_fill_in(times, cost_data, product_types, integrate, path):
+def plot_fill_in(rollup, group_by, integrate, path, min_cost=1.):
+
+    # Don't plot groups that cost less than min_cost in total
+    labels, times, costs, cost_integrated = rollup.timeline(
+        group_by, min_cost=min_cost)
+    if integrate:
+        cost_data = cost_integrated
+    else:
+        cost_data = costs
 
     fig, ax = plt.subplots()
-    running_sum = [0]*len(times)
-    for i in range(len(product_types)):
-        running_sum_new = [
-            running_sum[j] + cost_data[i, j] for j in range(len(times))]
+    running_sum = np.zeros(len(times))
+    for i in range(len(labels)):
+        running_sum_new = running_sum + cost_data[i, :]
         ax.fill_between(
             times, running_sum_new, running_sum, where=None,
-            label='{}: ${:.2f}'.format(product_types[i], cost_data[i, -1]))
+            label='{}: ${:.2f}'.format(
+                format_label(labels[i]), cost_integrated[i, -1]))
         running_sum = running_sum_new
     plt.xlabel("time")
     if integrate:
@@ -114,69 +112,550 @@ def plot_fill_in(times, cost_data, product_types, integrate, path):
     plt.savefig('{}/aws_costs_{}.png'.format(path, datetime.now().date()))
 
 
-def find_cost_report(anaconda_path, date):
+def format_label(label):
+
+    if isinstance(label, tuple):
+        return ' / '.join(label)
+    return label
+
+
+def find_cost_report(store, date):
 
+    # Latest cost report for the month containing date. The reports are
+    # written under s3://eorbilling//cost_report/, so their keys start with
+    # a slash.
     next_month = date + timedelta(days=+(40-date.day))
     subdir = "{}{:02d}01-{}{:02d}01".format(
         date.year, date.month, next_month.year, next_month.month)
-    reports_all = os.popen(
-        ("{}/aws s3 ls s3://eorbilling//cost_report/{}/ "
-         "--recursive").format(anaconda_path, subdir)).readlines()
-    reports = [rep for rep in reports_all if
-               rep.endswith('cost_report-1.csv.gz\n')]
-    latest_report = reports[0]
-    for rep in reports:
-        time = datetime.strptime(rep[:18], "%Y-%m-%d %H:%M:%S")
-        latest_report_time \
-            = datetime.strptime(latest_report[:18], "%Y-%m-%d %H:%M:%S")
-        if time > latest_report_time:
-            latest_report = rep
-    s3_path = "s3://eorbilling/{}".format(latest_report.split(' ')[-1])
-    s3_path = s3_path.rstrip()
-    return s3_path
-
-
-def get_data(path, anaconda_path, plot_days, date):
-
-    s3_path = find_cost_report(anaconda_path, date)
-
-    os.system("{}/aws s3 cp {} {}/".format(anaconda_path, s3_path, path))
-    os.system(("gunzip -f {}/cost_report-1.csv.gz > "
-               "{}/cost_report-1.csv").format(path, path))
-
-    datafile = open("{}/cost_report-1.csv".format(path), "r")
-    data = datafile.readlines()
-    datafile.close()
-
-    header = data[0].split(",")
-    charge_items = []
-    for i, data_line in enumerate(data[1:]):
-        new_charge = Lineitem(data_line, header)
-        if (new_charge.cost > 0.
-                and (datetime.now()-new_charge.endtime).total_seconds()
-                < plot_days*86400.):
-            charge_items.append(new_charge)
+    reports = [
+        report for report in store.list("/cost_report/{}/".format(subdir))
+        if report.key.endswith("cost_report-1.csv.gz")]
+    if len(reports) == 0:
+        return None
+    return max(reports, key=lambda report: report.last_modified)
+
+
+def get_data(path, store, start_date, end_date, cache_dir=None,
+             cache_max_size=1e9, cache_max_days=93., nprocs=4):
+
+    # Line items with usage between start_date and end_date, gathered from
+    # the latest cost report of every month in that window. Months are
+    # fetched and parsed in parallel worker processes and merged into a
+    # single time-sorted set.
+    # Parsed reports are cached in cache_dir keyed by the report's S3 key and
+    # upload time, so a report is only downloaded and parsed the first time
+    # it is seen.
+    if cache_dir is None:
+        cache_dir = "{}/cost_cache".format(path)
+
+    month_dates = []
+    month_date = datetime(start_date.year, start_date.month, 1)
+    while month_date <= end_date:
+        month_dates.append(month_date)
+        month_date = (month_date + timedelta(days=32)).replace(day=1)
+    load_args = [(store, month_date, cache_dir) for month_date in month_dates]
+
+    if len(load_args) > 1 and nprocs > 1:
+        pool = multiprocessing.Pool(min(nprocs, len(load_args)))
+        try:
+            month_items = pool.map(load_month, load_args)
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        month_items = [load_month(args) for args in load_args]
+    month_items = [items for items in month_items if items is not None]
+    evict_cache(cache_dir, cache_max_size, cache_max_days)
+
+    charge_items = merge_cost_items(month_items)
+    return charge_items.select(
+        (charge_items.endtimes > to_timestamp(start_date))
+        & (charge_items.starttimes < to_timestamp(end_date)))
+
+
+def load_month(args):
+
+    # Parsed line items from the latest cost report for a month, from the
+    # cache if possible. Returns None if the month has no report yet.
+    store, date, cache_dir = args
+    report = find_cost_report(store, date)
+    if report is None:
+        return None
+    cache_file = get_cache_filename(
+        cache_dir, report.key, report.last_modified)
+    charge_items = load_cached_report(cache_file)
+
+    if charge_items is None:
+        report_file = store.open(report.key)
+        try:
+            charge_items = read_cost_report(report_file)
+        finally:
+            report_file.close()
+        save_cached_report(
+            cache_file, charge_items, report.key, report.last_modified)
 
     return charge_items
 
 
-class Lineitem:
-
-    def __init__(self, data_line, header):
-        data_split = data_line.split(",")
-        self.starttime = datetime.strptime(
-            data_split[header.index("lineItem/UsageStartDate")],
-            "%Y-%m-%dT%H:%M:%SZ")
-        self.endtime = datetime.strptime(
-            data_split[header.index("lineItem/UsageEndDate")],
-            "%Y-%m-%dT%H:%M:%SZ")
-        self.duration = (self.endtime - self.starttime).total_seconds()
-        self.product = data_split[header.index("lineItem/ProductCode")]
-        self.usage_type = data_split[header.index("lineItem/UsageType")]
-        self.cost = float(data_split[header.index("lineItem/BlendedCost")])
-        self.cost_per_minute = self.cost/self.duration*60
-        self.description = data_split[
-            header.index("lineItem/LineItemDescription")]
+def merge_cost_items(items_list):
+
+    # Combine line items from several reports into one set sorted by start
+    # time. Rows that appear identically in more than one report are only
+    # kept from the first report they appear in.
+    if len(items_list) == 0:
+        return CostItems(
+            np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64),
+            np.zeros(0), np.zeros(0, dtype=np.intc), [],
+            np.zeros(0, dtype=np.intc), [], np.zeros(0, dtype=np.intc), [],
+            np.zeros(0, dtype=np.intc), [])
+
+    sources = np.concatenate([
+        np.full(len(items), i, dtype=np.intc)
+        for i, items in enumerate(items_list)])
+    merged = [np.concatenate([
+        getattr(items, column) for items in items_list])
+        for column in ["starttimes", "endtimes", "costs"]]
+    for codes_name, labels_name in [
+            ("product_codes", "products"),
+            ("usage_type_codes", "usage_types"),
+            ("description_codes", "descriptions"),
+            ("resource_codes", "resources")]:
+        labels = sorted(set().union(
+            *[getattr(items, labels_name) for items in items_list]))
+        lookup = {label: code for code, label in enumerate(labels)}
+        merged.append(np.concatenate([
+            np.array([lookup[label] for label in getattr(items, labels_name)],
+                     dtype=np.intc)[getattr(items, codes_name)]
+            for items in items_list]))
+        merged.append(labels)
+    (starttimes, endtimes, costs, product_codes, products, usage_type_codes,
+     usage_types, description_codes, descriptions, resource_codes,
+     resources) = merged
+
+    order = np.lexsort((
+        sources, costs, resource_codes, description_codes, usage_type_codes,
+        product_codes, endtimes, starttimes))
+    row_keys = np.column_stack((
+        starttimes, endtimes, product_codes, usage_type_codes,
+        description_codes, resource_codes, costs.view(np.int64)))[order]
+    group_start = np.ones(len(order), dtype=bool)
+    group_start[1:] = np.any(row_keys[1:] != row_keys[:-1], axis=1)
+    group_source = sources[order][group_start][np.cumsum(group_start) - 1]
+    order = order[sources[order] == group_source]
+
+    return CostItems(
+        starttimes[order], endtimes[order], costs[order],
+        product_codes[order], products, usage_type_codes[order], usage_types,
+        description_codes[order], descriptions, resource_codes[order],
+        resources)
+
+
+def get_cache_filename(cache_dir, report_key, report_time):
+
+    key = "{} {}".format(
+        report_key, report_time.strftime("%Y-%m-%dT%H:%M:%S"))
+    return "{}/{}.npz".format(
+        cache_dir, hashlib.sha1(key.encode("utf-8")).hexdigest())
+
+
+def load_cached_report(cache_file):
+
+    if not os.path.isfile(cache_file):
+        return None
+    try:
+        with np.load(cache_file) as cached:
+            charge_items = CostItems(
+                cached["starttimes"], cached["endtimes"], cached["costs"],
+                cached["product_codes"], cached["products"].tolist(),
+                cached["usage_type_codes"], cached["usage_types"].tolist(),
+                cached["description_codes"],
+                cached["descriptions"].tolist(), cached["resource_codes"],
+                cached["resources"].tolist())
+    except (IOError, KeyError, ValueError):
+        print("WARNING: Could not read cached report {}, ignoring it.".format(
+            cache_file))
+        return None
+    os.utime(cache_file, None)  # mark as recently used for eviction
+    return charge_items
+
+
+def save_cached_report(cache_file, charge_items, report_key, report_time):
+
+    # The month workers of get_data save their reports at the same time, so
+    # another one may create the cache directory first
+    cache_dir = os.path.dirname(cache_file)
+    if not os.path.isdir(cache_dir):
+        try:
+            os.makedirs(cache_dir)
+        except OSError:
+            if not os.path.isdir(cache_dir):
+                raise
+    # Write to a temporary file of this process first so an interrupted run
+    # can't leave a truncated cache entry behind
+    temp_file = "{}.{}.tmp.npz".format(
+        cache_file[:-len(".npz")], os.getpid())
+    np.savez(
+        temp_file, starttimes=charge_items.starttimes,
+        endtimes=charge_items.endtimes, costs=charge_items.costs,
+        product_codes=charge_items.product_codes,
+        products=np.array(charge_items.products),
+        usage_type_codes=charge_items.usage_type_codes,
+        usage_types=np.array(charge_items.usage_types),
+        description_codes=charge_items.description_codes,
+        descriptions=np.array(charge_items.descriptions),
+        resource_codes=charge_items.resource_codes,
+        resources=np.array(charge_items.resources),
+        report_key=np.array(report_key),
+        report_time=np.array(report_time.strftime("%Y-%m-%dT%H:%M:%S")))
+    os.rename(temp_file, cache_file)
+
+
+def evict_cache(cache_dir, max_size, max_days):
+
+    # Remove cached reports that haven't been used in max_days days, then
+    # remove the least recently used ones until the cache fits in max_size
+    # bytes. The cache directory doesn't exist until a report is saved.
+    if not os.path.isdir(cache_dir):
+        return
+    entries = []
+    for filename in os.listdir(cache_dir):
+        if filename.endswith(".npz"):
+            file_stat = os.stat(os.path.join(cache_dir, filename))
+            entries.append(
+                (file_stat.st_mtime, file_stat.st_size, filename))
+    entries.sort(reverse=True)
+
+    oldest_time = to_timestamp(datetime.now()) - max_days*86400.
+    total_size = 0
+    for mtime, size, filename in entries:
+        total_size += size
+        if mtime < oldest_time or total_size > max_size:
+            os.remove(os.path.join(cache_dir, filename))
+
+
+def read_cost_report(report_file):
+
+    # Stream a gzipped cost_report CSV, keeping only line items with a
+    # positive cost. Rows are decompressed and filtered one at a time and
+    # stored as columns, so memory scales with the number of kept line items
+    # rather than the size of the report. The plotted window is selected
+    # after the months are merged, in get_data.
+
+    reader = csv.reader(iter_gzip_lines(report_file))
+
+    header = next(reader)
+    start_col = header.index("lineItem/UsageStartDate")
+    end_col = header.index("lineItem/UsageEndDate")
+    product_col = header.index("lineItem/ProductCode")
+    usage_type_col = header.index("lineItem/UsageType")
+    cost_col = header.index("lineItem/BlendedCost")
+    description_col = header.index("lineItem/LineItemDescription")
+    # Only in reports with resource IDs enabled
+    if "lineItem/ResourceId" in header:
+        resource_col = header.index("lineItem/ResourceId")
+    else:
+        resource_col = None
+
+    starttimes = array.array("d")
+    endtimes = array.array("d")
+    costs = array.array("d")
+    product_codes = array.array("i")
+    usage_type_codes = array.array("i")
+    description_codes = array.array("i")
+    resource_codes = array.array("i")
+    products = {}
+    usage_types = {}
+    descriptions = {}
+    resources = {}
+    # Line items are mostly hourly, so the same timestamps recur many times
+    parsed_times = {}
+
+    for row in reader:
+        if not row[cost_col] or float(row[cost_col]) <= 0.:
+            continue
+        endtime = parsed_times.get(row[end_col])
+        if endtime is None:
+            endtime = parsed_times[row[end_col]] = to_timestamp(
+                datetime.strptime(row[end_col], "%Y-%m-%dT%H:%M:%SZ"))
+        starttime = parsed_times.get(row[start_col])
+        if starttime is None:
+            starttime = parsed_times[row[start_col]] = to_timestamp(
+                datetime.strptime(row[start_col], "%Y-%m-%dT%H:%M:%SZ"))
+        starttimes.append(starttime)
+        endtimes.append(endtime)
+        costs.append(float(row[cost_col]))
+        product_codes.append(
+            products.setdefault(row[product_col], len(products)))
+        usage_type_codes.append(
+            usage_types.setdefault(row[usage_type_col], len(usage_types)))
+        description_codes.append(
+            descriptions.setdefault(row[description_col], len(descriptions)))
+        resource = row[resource_col] if resource_col is not None else ""
+        resource_codes.append(resources.setdefault(resource, len(resources)))
+
+    return CostItems(
+        np.frombuffer(starttimes, dtype=float).astype(np.int64),
+        np.frombuffer(endtimes, dtype=float).astype(np.int64),
+        np.frombuffer(costs, dtype=float),
+        np.frombuffer(product_codes, dtype=np.intc), category_labels(products),
+        np.frombuffer(usage_type_codes, dtype=np.intc),
+        category_labels(usage_types),
+        np.frombuffer(description_codes, dtype=np.intc),
+        category_labels(descriptions),
+        np.frombuffer(resource_codes, dtype=np.intc),
+        category_labels(resources))
+
+
+def iter_gzip_lines(compressed_file, chunk_size=1 << 20):
+
+    # Decompress a gzip stream chunk by chunk and yield its lines. Unlike
+    # gzip.GzipFile this only needs read(), so it also works directly on
+    # network streams.
+    decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+    remainder = b""
+    while True:
+        chunk = compressed_file.read(chunk_size)
+        if not chunk:
+            break
+        data = remainder + decompressor.decompress(chunk)
+        # Concatenated gzip members start a new decompressor
+        while decompressor.unused_data:
+            unused_data = decompressor.unused_data
+            decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+            data += decompressor.decompress(unused_data)
+        lines = data.split(b"\n")
+        remainder = lines.pop()
+        for line in lines:
+            yield decode_line(line + b"\n")
+    remainder += decompressor.flush()
+    if remainder:
+        yield decode_line(remainder)
+
+
+def decode_line(line):
+
+    if sys.version_info[0] >= 3:
+        return line.decode("utf-8")
+    return line
+
+
+def category_labels(codes):
+
+    labels = [None]*len(codes)
+    for label, code in codes.items():
+        labels[code] = label
+    return labels
+
+
+def compact_categories(codes, labels):
+
+    used_codes, new_codes = np.unique(codes, return_inverse=True)
+    return (new_codes.astype(np.intc),
+            [labels[code] for code in used_codes])
+
+
+class CostItems:
+
+    # Columnar set of cost report line items. Times are in seconds since the
+    # epoch and the product, usage type, description and resource ID columns
+    # are stored as integer codes into the corresponding label lists.
+
+    def __init__(self, starttimes, endtimes, costs, product_codes, products,
+                 usage_type_codes, usage_types, description_codes,
+                 descriptions, resource_codes, resources):
+        self.starttimes = starttimes
+        self.endtimes = endtimes
+        self.costs = costs
+        self.product_codes = product_codes
+        self.products = products
+        self.usage_type_codes = usage_type_codes
+        self.usage_types = usage_types
+        self.description_codes = description_codes
+        self.descriptions = descriptions
+        self.resource_codes = resource_codes
+        self.resources = resources
+
+    def __len__(self):
+        return len(self.costs)
+
+    def select(self, use):
+        # Return the line items where use is True, dropping any category
+        # labels that no longer appear
+        product_codes, products = compact_categories(
+            self.product_codes[use], self.products)
+        usage_type_codes, usage_types = compact_categories(
+            self.usage_type_codes[use], self.usage_types)
+        description_codes, descriptions = compact_categories(
+            self.description_codes[use], self.descriptions)
+        resource_codes, resources = compact_categories(
+            self.resource_codes[use], self.resources)
+        return CostItems(
+            self.starttimes[use], self.endtimes[use], self.costs[use],
+            product_codes, products, usage_type_codes, usage_types,
+            description_codes, descriptions, resource_codes, resources)
+
+
+class CostRollup:
+
+    # Cost of every group of line items with the same values of the given
+    # dimensions (any of product, usage type and description) in each
+    # resolution-minute time bin of a window ending at end_time. Built once
+    # from a CostItems set; views grouped by any subset of the dimensions
+    # and top-N queries are then sums over rows of this cube, so they don't
+    # need another pass over the line items. Memory scales with the number
+    # of groups times the number of bins, so roll up only the dimensions
+    # that are needed.
+    # Each line item's cost is spread uniformly over its usage interval and
+    # split exactly between the bins it overlaps.
+
+    def __init__(self, charge_items, end_time, days, resolution=1,
+                 dimensions=('product',)):
+        self.resolution = resolution
+        self.dimensions = tuple(dimensions)
+        self.labels = {
+            'product': charge_items.products,
+            'usage_type': charge_items.usage_types,
+            'description': charge_items.descriptions}
+        dimension_codes = {
+            'product': charge_items.product_codes,
+            'usage_type': charge_items.usage_type_codes,
+            'description': charge_items.description_codes}
+        item_codes = np.column_stack(
+            [dimension_codes[dim] for dim in self.dimensions])
+        # Each row of group_codes gives the codes of one group in each of the
+        # dimensions
+        if len(charge_items) > 0:
+            self.group_codes, item_groups = unique_rows(item_codes)
+        else:
+            self.group_codes = np.zeros((0, len(self.dimensions)),
+                                        dtype=np.intc)
+            item_groups = np.zeros(0, dtype=np.intp)
+        self.n_groups = len(self.group_codes)
+
+        self.times, self.costs = self.bin_costs(
+            charge_items, item_groups, end_time, days)
+        self.totals = np.sum(self.costs, axis=1)
+
+    def bin_costs(self, charge_items, item_groups, end_time, days):
+
+        # Bin edges run back from end_time, trimmed to the span of the data
+        end_stamp = to_timestamp(end_time)
+        offsets = 60.*self.resolution*np.arange(
+            -int(days*1440/self.resolution), 1)
+        edges = end_stamp + offsets
+        if len(charge_items) > 0:
+            first = max(np.searchsorted(
+                edges, np.min(charge_items.starttimes), side='right') - 1, 0)
+            last = np.searchsorted(edges, np.max(charge_items.endtimes))
+            edges = edges[first:last+1]
+        nedges = len(edges)
+        if nedges < 2:
+            return [], np.zeros((self.n_groups, 0))
+
+        # The cost accrued by time t is the sum over items of
+        # rate*(t - start) for items started before t, minus
+        # rate*(t - end) for items ended before t. Accumulate the
+        # rate and rate*time terms at each edge with bincounts and
+        # cumulative sums, measuring times from the first edge.
+        starts = charge_items.starttimes - edges[0]
+        ends = charge_items.endtimes - edges[0]
+        with np.errstate(divide='ignore', invalid='ignore'):
+            rates = charge_items.costs/(ends - starts)
+        rates[~np.isfinite(rates)] = 0.
+        start_inds = item_groups*(nedges+1) + np.searchsorted(
+            edges - edges[0], starts, side='right')
+        end_inds = item_groups*(nedges+1) + np.searchsorted(
+            edges - edges[0], ends, side='right')
+        size = self.n_groups*(nedges+1)
+        rate_sums = (
+            np.bincount(start_inds, weights=rates, minlength=size)
+            - np.bincount(end_inds, weights=rates, minlength=size)
+            ).reshape(self.n_groups, nedges+1)[:, :-1]
+        np.cumsum(rate_sums, axis=1, out=rate_sums)
+        offset_sums = (
+            np.bincount(start_inds, weights=rates*starts, minlength=size)
+            - np.bincount(end_inds, weights=rates*ends, minlength=size)
+            ).reshape(self.n_groups, nedges+1)[:, :-1]
+        np.cumsum(offset_sums, axis=1, out=offset_sums)
+        accrued = rate_sums
+        accrued *= edges - edges[0]
+        accrued -= offset_sums
+        del offset_sums
+
+        times = [from_timestamp(edge) for edge in edges[1:]]
+        return times, np.diff(accrued, axis=1)
+
+    def group_rows(self, group_by):
+
+        # Labels for each distinct combination of the group_by dimensions,
+        # and which of them each group belongs to
+        missing = [dim for dim in group_by if dim not in self.dimensions]
+        if len(missing) > 0:
+            raise ValueError(
+                'Rollup has no {} dimension; it was built for {}.'.format(
+                    ', '.join(missing), ', '.join(self.dimensions)))
+        dims = [self.dimensions.index(dim) for dim in group_by]
+        if self.n_groups == 0:
+            return [], np.zeros(0, dtype=np.intp)
+        codes, rows = unique_rows(self.group_codes[:, dims])
+        labels = []
+        for code in codes:
+            label = tuple(
+                self.labels[group_by[i]][code[i]] for i in range(len(dims)))
+            if len(label) == 1:
+                label = label[0]
+            labels.append(label)
+        return labels, rows
+
+    def total_costs(self, group_by=('product',)):
+
+        # Total cost of each group over the whole window, most expensive
+        # first
+        labels, rows = self.group_rows(group_by)
+        totals = np.bincount(rows, weights=self.totals, minlength=len(labels))
+        order = np.argsort(totals)[::-1]
+        return [labels[i] for i in order], totals[order]
+
+    def top(self, n, group_by=('product',)):
+
+        labels, totals = self.total_costs(group_by)
+        return labels[:n], totals[:n]
+
+    def group_costs(self, group_by=('product',)):
+
+        # Cost in each time bin for each group, most expensive first
+        labels, rows = self.group_rows(group_by)
+        costs = np.zeros((len(labels), len(self.times)))
+        order = np.argsort(rows, kind='mergesort')
+        if len(order) > 0:
+            bounds = np.flatnonzero(np.diff(np.r_[-1, rows[order]]))
+            costs = np.add.reduceat(self.costs[order], bounds, axis=0)
+        group_order = np.argsort(np.sum(costs, axis=1))[::-1]
+        return ([labels[i] for i in group_order], self.times,
+                costs[group_order])
+
+    def timeline(self, group_by=('product',), min_cost=None):
+
+        # Cost rate (USD per minute) in each bin and cost integrated up to the
+        # end of each bin, for each group costing at least min_cost
+        labels, times, costs = self.group_costs(group_by)
+        cost_integrated = np.cumsum(costs, axis=1)
+        if min_cost is not None and len(times) > 0:
+            keep = cost_integrated[:, -1] >= min_cost
+            labels = [label for label, use in zip(labels, keep) if use]
+            costs = costs[keep]
+            cost_integrated = cost_integrated[keep]
+        return labels, times, costs/self.resolution, cost_integrated
+
+
+def unique_rows(values):
+
+    # Unique rows of a 2D integer array and the index of each row's match
+    keys = np.ascontiguousarray(values).view(
+        np.dtype((np.void, values.dtype.itemsize*values.shape[1])))
+    unique_keys, inverse = np.unique(keys.ravel(), return_inverse=True)
+    unique_values = unique_keys.view(values.dtype).reshape(-1, values.shape[1])
+    return unique_values, inverse
 
 
 if __name__ == "__main__":
@@ -74,42 +74,8 @@ then
 fi
 ############End of check inputs
 
-n_evenodd=${#evenodd[@]}
-n_pol=${#pol[@]}
-num_files=$(($n_evenodd * $n_pol))
-
-#aws s3 ls command cannot use wildcards, hence this workaround  - 3/2018
-ls_output_size=( $(aws s3 ls ${FHDdir}/Healpix/ | tr -s ' ' | cut -d' ' -f3) )
-ls_output_filename=( $(aws s3 ls ${FHDdir}/Healpix/ | tr -s ' ' | cut -d' ' -f4) )
-
-#Check that the size of the Healpix cubes are greater than the min
-i=0
-unset miss_flag
-for file_size in "${ls_output_size[@]}"
-do
-    if [[ $file_size -lt "$min_size" ]]
-    then
-        if [ -z ${miss_flag} ]
-        then
-            echo HEALPix cubes smaller than specified min_size:
-            miss_flag=1
-        fi
-        echo ${ls_output_filename[$i]}
-    fi
-    (( ++i ))
-done
-
-#Check that all Healpix cubes are present, print if they are not
-unset miss_flag
-while read line
-do
-    if [[ "$(grep -o $line <<< ${ls_output_filename[*]} | wc -l)" -ne "$num_files" ]]
-    then
-        if [ -z ${miss_flag} ]
-        then
-            echo Some HEALPix cubes are missing:
-            miss_flag=1
-        fi
-        echo $line
-    fi
-done < $check_list
+#Index the Healpix listing once and check every obsid against it
+evenodd_list=${evenodd[*]}
+pol_list=${pol[*]}
+inventory_check.py -f ${check_list} -d ${FHDdir} -e ${evenodd_list// /,} \
+-p ${pol_list// /,} --min_size ${min_size} --skip_inputs
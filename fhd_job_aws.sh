@@ -9,9 +9,11 @@
 echo JOBID ${JOB_ID}
 echo TASKID ${SGE_TASK_ID}
 echo OBSID ${obs_id}
+echo VERSION ${version}
 echo "JOB START TIME" `date +"%Y-%m-%d_%H:%M:%S"`
 myip="$(dig +short myip.opendns.com @resolver1.opendns.com)"
 echo PUBLIC IP ${myip}
+echo INSTANCE ID $(curl -s --max-time 2 http://169.254.169.254/latest/meta-data/instance-id)
 
 #set defaults
 if [ -z ${nslots} ]; then
@@ -32,6 +34,9 @@ fi
 if [ -z ${metafits_s3_loc} ]; then
     metafits_s3_loc=s3://mwatest/metafits/4.1
 fi
+if [ -z ${staging_cache_size} ]; then
+    staging_cache_size=100000000000
+fi
 if [ -z ${version} ]; then
     >&2 echo "ERROR: no version provided"
     exit 1
@@ -62,50 +67,34 @@ else
     sudo mkdir -m 777 /uvfits
 fi
 
-# Check if the uvfits file exists locally; if not, download it from S3
-if [ ! -f "/uvfits/${obs_id}.uvfits" ]; then
+echo "DOWNLOAD START TIME" `date +"%Y-%m-%d_%H:%M:%S"`
 
-    # Check that the uvfits file exists on S3
-    uvfits_exists=$(aws s3 ls ${uvfits_s3_loc}/${obs_id}.uvfits)
-    if [ -z "$uvfits_exists" ]; then
-        >&2 echo "ERROR: uvfits file not found"
-        echo "Job Failed"
-        exit 1
-    fi
-
-    # Download uvfits from S3
-    sudo aws s3 cp ${uvfits_s3_loc}/${obs_id}.uvfits \
-    /uvfits/${obs_id}.uvfits --quiet
-
-    # Verify that the uvfits downloaded correctly
-    if [ ! -f "/uvfits/${obs_id}.uvfits" ]; then
-        >&2 echo "ERROR: downloading uvfits from S3 failed"
-        echo "Job Failed"
-        exit 1
-    fi
+# Stage the uvfits and metafits through the node's shared cache, which
+# reuses copies left by earlier jobs and shares downloads between slots
+staging_cache.py fetch ${uvfits_s3_loc}/${obs_id}.uvfits \
+--pin ${JOB_ID}.${SGE_TASK_ID} --max_size ${staging_cache_size} > /dev/null
+fetch_status=$?
+if [ $fetch_status -eq 2 ]; then
+    >&2 echo "ERROR: uvfits file not found"
+    echo "Job Failed"
+    exit 1
+elif [ $fetch_status -ne 0 ]; then
+    >&2 echo "ERROR: downloading uvfits from S3 failed"
+    echo "Job Failed"
+    exit 1
 fi
 
-# Check if the metafits file exists locally; if not, download it from S3
-if [ ! -f "/uvfits/${obs_id}.metafits" ]; then
-
-    # Check that the metafits file exists on S3
-    metafits_exists=$(aws s3 ls ${metafits_s3_loc}/${obs_id}.metafits)
-    if [ -z "$metafits_exists" ]; then
-        >&2 echo "ERROR: metafits file not found"
-        echo "Job Failed"
-        exit 1
-    fi
-
-    # Download metafits from S3
-    sudo aws s3 cp ${metafits_s3_loc}/${obs_id}.metafits \
-    /uvfits/${obs_id}.metafits --quiet
-
-    # Verify that the metafits downloaded correctly
-    if [ ! -f "/uvfits/${obs_id}.metafits" ]; then
-        >&2 echo "ERROR: downloading metafits from S3 failed"
-        echo "Job Failed"
-        exit 1
-    fi
+staging_cache.py fetch ${metafits_s3_loc}/${obs_id}.metafits \
+--pin ${JOB_ID}.${SGE_TASK_ID} --max_size ${staging_cache_size} > /dev/null
+fetch_status=$?
+if [ $fetch_status -eq 2 ]; then
+    >&2 echo "ERROR: metafits file not found"
+    echo "Job Failed"
+    exit 1
+elif [ $fetch_status -ne 0 ]; then
+    >&2 echo "ERROR: downloading metafits from S3 failed"
+    echo "Job Failed"
+    exit 1
 fi
 
 #Get input_vis files
@@ -156,10 +145,13 @@ fi
 aws s3 cp ${s3_path}/fhd_${version}/ ${outdir}/fhd_${version}/ --recursive \
 --exclude "*" --include "*${obs_id}*" --quiet
 
-# Run backup script in the background
-fhd_on_aws_backup.sh $outdir $s3_path $version $JOB_ID $myip &
+echo "DOWNLOAD END TIME" `date +"%Y-%m-%d_%H:%M:%S"`
+
+# Checkpoint outputs to S3 in the background
+checkpoint_uploader.py $outdir $s3_path $version $JOB_ID $myip $obs_id &
 
 # Run FHD
+echo "IDL START TIME" `date +"%Y-%m-%d_%H:%M:%S"`
 idl -IDL_DEVICE ps -IDL_CPU_TPOOL_NTHREADS $nslots -e $versions_script -args \
 $obs_id $outdir $version aws || :
 
@@ -171,10 +163,12 @@ else
     echo "Job Failed"
     error_mode=1
 fi
+echo "IDL END TIME" `date +"%Y-%m-%d_%H:%M:%S"`
 
-kill $(jobs -p) #kill fhd_on_aws_backup.sh
+kill $(jobs -p) #kill checkpoint_uploader.py
 
 # Move FHD outputs to S3
+echo "UPLOAD START TIME" `date +"%Y-%m-%d_%H:%M:%S"`
 i=1  #initialize counter
 aws s3 mv ${outdir}/fhd_${version}/ ${s3_path}/fhd_${version}/ --recursive \
 --exclude "*" --include "*${obs_id}*" --quiet
@@ -184,10 +178,15 @@ while [ $? -ne 0 ] && [ $i -lt 10 ]; do
     aws s3 mv ${outdir}/fhd_${version}/ ${s3_path}/fhd_${version}/ \
     --recursive --exclude "*" --include "*${obs_id}*" --quiet
 done
-
-# Remove uvfits and metafits from the instance
-sudo rm /uvfits/${obs_id}.uvfits
-sudo rm /uvfits/${obs_id}.metafits
+echo "UPLOAD ATTEMPTS" $i
+echo "UPLOAD END TIME" `date +"%Y-%m-%d_%H:%M:%S"`
+
+# Release the uvfits and metafits; they stay in the node's cache for later
+# jobs until they are evicted
+staging_cache.py release ${uvfits_s3_loc}/${obs_id}.uvfits \
+--pin ${JOB_ID}.${SGE_TASK_ID}
+staging_cache.py release ${metafits_s3_loc}/${obs_id}.metafits \
+--pin ${JOB_ID}.${SGE_TASK_ID}
 
 echo "JOB END TIME" `date +"%Y-%m-%d_%H:%M:%S"`
 
@@ -9,6 +9,8 @@
 #inputs needed: file_path_cubes, obs_list_path, obs_list_array, version, chunk, nslots, 
 #evenodd, pol
 #chunk is the chunk number when the list was broken up. 0 for "master" or only chunk
+#inputs optional: int_name, the name of the integrated cube, and members_array, the ':'
+#separated obsids it contains (both set by integration_planner.py)
 
 echo JOBID ${JOB_ID}
 echo VERSION ${version}
@@ -26,7 +28,10 @@ else
 fi
 
 #***If the integration has been split up into chunks, name the save file specifically off of that.
-if [ "$chunk" -gt "0" ]; then
+if [ ! -z ${int_name} ]; then
+    int_filename=${int_name}_${evenodd}_cube${pol^^}.sav
+    save_file_evenoddpol=/Healpix/${int_filename}
+elif [ "$chunk" -gt "0" ]; then
     int_filename=Combined_obs_${version}_int_chunk${chunk}_${evenodd}_cube${pol^^}.sav
     save_file_evenoddpol=/Healpix/${int_filename}
 else
@@ -127,10 +132,10 @@ then
     #***
 
     ####Run the integration IDL script
-    idl -IDL_DEVICE ps -IDL_CPU_TPOOL_NTHREADS $nslots -e integrate_healpix_cubes -args "$evenoddpol_file_paths" "$save_file_evenoddpol" || :
+    idl -IDL_DEVICE ps -IDL_CPU_TPOOL_NTHREADS $nslots -e integrate_healpix_cubes -args "$evenoddpol_file_paths" "$save_file_evenoddpol"
     #***
 
-    if [ $? -eq 0 ]
+    if [ $? -eq 0 ] && [ -f "${save_file_evenoddpol}" ]
     then
         echo "Integration Job Finished"
         error_mode=0
@@ -143,13 +148,31 @@ then
     i=1  #initialize counter
     aws s3 mv ${save_file_evenoddpol} \
     ${file_path_cubes}${save_file_evenoddpol} --quiet
-    while [ $? -ne 0 ] && [ $i -lt 10 ]; do
+    move_status=$?
+    while [ $move_status -ne 0 ] && [ $i -lt 10 ]; do
         let "i += 1"  #increment counter
         >&2 echo "Moving FHD outputs to S3 failed. Retrying (attempt $i)."
         aws s3 mv ${save_file_evenoddpol} \
         ${file_path_cubes}${save_file_evenoddpol} --quiet
+        move_status=$?
     done
 
+    # Record the obsids in the integrated cube next to it, which is what lets
+    # integration_planner.py reuse it or skip it as up to date. Only done once
+    # the cube is in S3, so a failed integration is planned again.
+    if [ ! -z ${int_name} ] && [ ! -z "${members_array}" ] && \
+     [ $error_mode -eq 0 ] && [ $move_status -eq 0 ]; then
+        members_file=/Healpix/${int_name}_members.txt
+        echo ${members_array} | tr ':' '\n' > $members_file
+        i=1  #initialize counter
+        aws s3 cp $members_file ${file_path_cubes}/Healpix/${int_name}_members.txt --quiet
+        while [ $? -ne 0 ] && [ $i -lt 10 ]; do
+            let "i += 1"  #increment counter
+            >&2 echo "Uploading ${int_name}_members.txt to S3 failed. Retrying (attempt $i)."
+            aws s3 cp $members_file ${file_path_cubes}/Healpix/${int_name}_members.txt --quiet
+        done
+    fi
+
     echo "JOB END TIME" `date +"%Y-%m-%d_%H:%M:%S"`
 
     # Move integration logs to S3
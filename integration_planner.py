@@ -0,0 +1,299 @@
+#!/usr/bin/env python
+
+# Plans the integration of HEALPix cubes for run_eppsilon_aws.sh as a tree
+# of integration_job_aws.sh jobs instead of fixed chunks of 20 under one
+# master integration. The fan-in of the tree is chosen from the number of
+# cubes to integrate, their size, the number of integration jobs that can
+# run at once and the space one job has for its input cubes. Intermediate
+# subcubes are named by the obsids they contain and a list of those obsids
+# is kept next to them in Healpix/, so a later integration of any superset
+# reuses them and only integrates the new observations. The obsid list,
+# <name>_members.txt, is uploaded by integration_job_aws.sh once the cube is
+# in S3, so an integration that failed or hasn't run yet is planned again.
+#
+# Usage: integration_planner.py -d fhd_dir -f integrate_list -v version
+#            [--job_slots 8] [--job_memory 100e9] > plan.txt
+#
+# Prints one line per node of the tree, children before parents:
+#   chunk int_name obs_list_path obs_list_array holds members_array
+# where obs_list_array is the ':' separated inputs of the node, holds the
+# ',' separated chunks of the nodes it has to wait for ('-' if none) and
+# members_array the ':' separated obsids the node's cube will contain.
+# Each node is integrated by an integration_job_aws.sh job for each even/odd
+# and pol. The last line is the root, Combined_obs_<version>.
+#
+# Inputs whose cubes aren't in Healpix/ yet (e.g. when run_eppsilon_aws.sh
+# -h holds the integration on a firstpass that is still running) are
+# planned like the others, as cubes of --cube_size bytes that will exist by
+# the time the jobs run. Only complete subcubes are reused. Exits with 1 if
+# Combined_obs_<version> already has cubes that were recorded as integrated
+# from a different list, since integration_job_aws.sh would keep them.
+
+import os
+import sys
+import math
+import hashlib
+import optparse
+import object_store
+from inventory_check import list_location
+
+evenodds = ['even', 'odd']
+pols = ['XX', 'YY']
+cube_products = ['_{}_cube{}.sav'.format(evenodd, pol)
+                 for evenodd in evenodds for pol in pols]
+subcube_prefix = 'Combined_obs_sub_'
+members_suffix = '_members.txt'
+
+
+class IntegrationNode:
+
+    # A cube in the integration tree: an observation, an existing subcube or
+    # an integration to run (chunk > 0) of the nodes in inputs
+
+    def __init__(self, name, members, inputs=(), chunk=0):
+        self.name = name
+        self.members = frozenset(members)
+        self.inputs = inputs
+        self.chunk = chunk
+
+    def sort_key(self):
+        return min(self.members)
+
+
+def get_subcube_name(members):
+
+    return '{}{}'.format(subcube_prefix, hashlib.sha1('\n'.join(
+        sorted(members)).encode('utf-8')).hexdigest()[:16])
+
+
+def get_complete_cubes(sizes):
+
+    # Names that have all even/odd and pol cubes, with the median size of
+    # their cubes
+    found = {}
+    for filename, size in sizes.items():
+        for product in cube_products:
+            if filename.endswith(product):
+                found.setdefault(filename[:-len(product)], []).append(size)
+    return dict([(name, sorted(cube_sizes)[len(cube_sizes)//2])
+                 for name, cube_sizes in found.items()
+                 if len(cube_sizes) == len(cube_products)])
+
+
+def read_members(store, prefix, name):
+
+    members_file = store.open('{}{}{}'.format(prefix, name, members_suffix))
+    try:
+        members = members_file.read()
+    finally:
+        members_file.close()
+    if not isinstance(members, str):
+        members = members.decode('utf-8')
+    return frozenset(members.split())
+
+
+def cover_with_subcubes(obs_list, subcubes):
+
+    # Greedily pick disjoint existing subcubes (name: members) made only of
+    # observations in obs_list, largest first. Returns the chosen subcube
+    # names and the observations they don't cover.
+    remaining = set(obs_list)
+    chosen = []
+    for members, name in sorted(
+            [(members, name) for name, members in subcubes.items()],
+            key=lambda subcube: (-len(subcube[0]), subcube[1])):
+        if len(members) > 1 and members <= remaining:
+            chosen.append(name)
+            remaining -= members
+    return chosen, sorted(remaining)
+
+
+def get_plan_time(n_units, fan_in, cube_size, job_slots, overhead,
+                  throughput):
+
+    # Estimated wall-clock seconds to reduce n_units cubes with the given
+    # fan-in: each level runs its jobs (one per even/odd and pol per node)
+    # in waves of job_slots, and each job takes the overhead plus the time
+    # to stage and read its input cubes
+    total_time = 0.
+    while True:
+        n_nodes = int(math.ceil(n_units/float(fan_in)))
+        n_inputs = int(math.ceil(n_units/float(n_nodes)))
+        n_waves = math.ceil(n_nodes*len(cube_products)/float(job_slots))
+        total_time += n_waves*(overhead + n_inputs*cube_size/throughput)
+        if n_nodes == 1:
+            return total_time
+        n_units = n_nodes
+
+
+def choose_fan_in(n_units, cube_size, job_memory, job_slots, overhead=300.,
+                  throughput=50e6):
+
+    # Fan-in with the shortest estimated time, from 2 up to the number of
+    # cubes one job has space for. Ties go to the larger fan-in, which runs
+    # fewer jobs.
+    max_fan_in = max(2, int(job_memory//cube_size) - 1)
+    fan_ins = range(2, max(2, min(max_fan_in, n_units)) + 1)
+    return min(fan_ins, key=lambda fan_in: (get_plan_time(
+        n_units, fan_in, cube_size, job_slots, overhead, throughput),
+        -fan_in))
+
+
+def split_groups(units, fan_in):
+
+    # Consecutive groups of at most fan_in units, as equal in size as
+    # possible
+    n_groups = int(math.ceil(len(units)/float(fan_in)))
+    bounds = [len(units)*group//n_groups for group in range(n_groups + 1)]
+    return [units[bounds[group]:bounds[group + 1]]
+            for group in range(n_groups)]
+
+
+def get_leaves(obs_list, subcubes):
+
+    # Existing subcubes and observations to build the tree from, in obsid
+    # order so that nearby observations are integrated together
+    reused, new_obs = cover_with_subcubes(obs_list, subcubes)
+    return sorted([IntegrationNode(name, subcubes[name]) for name in reused]
+                  + [IntegrationNode(obs, [obs]) for obs in new_obs],
+                  key=IntegrationNode.sort_key)
+
+
+def plan_integration(units, root_name, fan_in, complete, members):
+
+    # Integration nodes to run, children before parents, to reduce units
+    # into root_name. complete holds the names that already have all their
+    # cubes and members the recorded members of existing integrations; an
+    # integration is only skipped if both match. Nothing is run if the root
+    # is already up to date, even if some of its subcubes are gone.
+    root_members = frozenset().union(*[unit.members for unit in units])
+    if root_name in complete and members.get(root_name) == root_members:
+        return []
+    jobs = []
+    while True:
+        groups = split_groups(units, fan_in)
+        next_units = []
+        for group in groups:
+            if len(group) == 1 and len(groups) > 1:
+                next_units.append(group[0])
+                continue
+            group_members = frozenset().union(
+                *[unit.members for unit in group])
+            if len(groups) == 1:
+                name = root_name
+            else:
+                name = get_subcube_name(group_members)
+            node = IntegrationNode(name, group_members, group)
+            if name not in complete or members.get(name) != node.members:
+                node.chunk = len(jobs) + 1
+                jobs.append(node)
+            next_units.append(node)
+        if len(groups) == 1:
+            return jobs
+        units = next_units
+
+
+if __name__ == '__main__':
+    o = optparse.OptionParser(
+        usage='%prog -d fhd_dir -f integrate_list -v version [options]')
+    o.add_option('-d', dest='fhd_dir', type='str',
+                 help='FHD directory with the cubes in Healpix/.')
+    o.add_option('-f', dest='integrate_list', type='str',
+                 help='Text file of obs ids or subcubes to integrate.')
+    o.add_option('-v', dest='version', type='str',
+                 help='Version, the root is named Combined_obs_<version>.')
+    o.add_option('--job_slots', type='int', default=8,
+                 help='Integration jobs that can run at once '
+                      '[default %default].')
+    o.add_option('--job_memory', type='float', default=100e9,
+                 help='Bytes of input cubes one job can hold '
+                      '[default %default].')
+    o.add_option('--overhead', type='float', default=300.,
+                 help='Seconds of overhead per job [default %default].')
+    o.add_option('--throughput', type='float', default=50e6,
+                 help='Bytes per second a job stages and reads input cubes '
+                      'at [default %default].')
+    o.add_option('--cube_size', type='float', default=5e9,
+                 help='Bytes per cube, used if none of the inputs\' cubes '
+                      'exist yet [default %default].')
+    o.add_option('--fan_in', type='int',
+                 help='Use this fan-in instead of choosing one.')
+    o.add_option('--list_dir', type='str', default='/Healpix',
+                 help='Directory for the obs lists of the jobs '
+                      '[default %default].')
+    opts, args = o.parse_args(sys.argv[1:])
+    if opts.fhd_dir is None or opts.integrate_list is None or \
+            opts.version is None:
+        o.error('Specify -d, -f and -v.')
+
+    obs_list = sorted(set([line.strip() for line in open(opts.integrate_list)
+                           if line.strip()]))
+    healpix_dir = '{}/Healpix/'.format(opts.fhd_dir.rstrip('/'))
+    store, prefix = object_store.split_url(healpix_dir)
+    sizes = list_location(healpix_dir, recursive=True, max_age=0)
+    complete = get_complete_cubes(sizes)
+
+    missing = [obs for obs in obs_list if obs not in complete]
+    if len(missing) > 0:
+        sys.stderr.write(
+            'WARNING: HEALPix cubes not found yet for {} of {} inputs; '
+            'planning them as cubes still to be made:\n{}\n'.format(
+                len(missing), len(obs_list), '\n'.join(missing)))
+
+    # Members of the existing integrations that recorded them. Only subcubes
+    # are reused as inputs; the root is just checked for being up to date.
+    root_name = 'Combined_obs_{}'.format(opts.version)
+    members = dict([
+        (name, read_members(store, prefix, name)) for name in complete
+        if name.startswith(subcube_prefix) and
+        '{}{}'.format(name, members_suffix) in sizes])
+    subcubes = dict(members)
+
+    # integration_job_aws.sh keeps any root cubes that exist, even if only
+    # some of them do, so they must have been integrated from this list
+    root_cubes = ['{}{}'.format(root_name, product)
+                  for product in cube_products
+                  if '{}{}'.format(root_name, product) in sizes]
+    if '{}{}'.format(root_name, members_suffix) in sizes:
+        members[root_name] = read_members(store, prefix, root_name)
+        if len(root_cubes) > 0 and members[root_name] != frozenset(obs_list):
+            sys.stderr.write(
+                'ERROR: {} was integrated from {} observations, not from '
+                'the {} in {}. Remove its cubes and {}{} from Healpix/ to '
+                'integrate it again.\n'.format(
+                    root_name, len(members[root_name]), len(obs_list),
+                    opts.integrate_list, root_name, members_suffix))
+            sys.exit(1)
+
+    units = get_leaves(obs_list, subcubes)
+    input_sizes = [complete[obs] for obs in obs_list if obs in complete]
+    if len(input_sizes) > 0:
+        cube_size = sorted(input_sizes)[len(input_sizes)//2]
+    else:
+        cube_size = opts.cube_size
+    if opts.fan_in is not None:
+        fan_in = opts.fan_in
+    else:
+        fan_in = choose_fan_in(len(units), cube_size, opts.job_memory,
+                               opts.job_slots, opts.overhead, opts.throughput)
+    jobs = plan_integration(units, root_name, fan_in, complete, members)
+
+    if len(root_cubes) > 0 and root_name not in members:
+        sys.stderr.write(
+            'WARNING: {} has cubes that don\'t record which observations '
+            'they were integrated from. integration_job_aws.sh will keep '
+            'them; remove them from Healpix/ to integrate again.\n'.format(
+                root_name))
+    n_reused = len([unit for unit in units if unit.name in subcubes])
+    sys.stderr.write(
+        '{} inputs, {} existing subcubes reused, {} integrations ({} jobs) '
+        'with fan-in {}\n'.format(len(obs_list), n_reused, len(jobs),
+                                  len(jobs)*len(cube_products), fan_in))
+
+    for job in jobs:
+        holds = [str(unit.chunk) for unit in job.inputs if unit.chunk > 0]
+        print('{} {} {} {} {} {}'.format(
+            job.chunk, job.name,
+            os.path.join(opts.list_dir, '{}_obs_list.txt'.format(job.name)),
+            ':'.join([unit.name for unit in job.inputs]),
+            ','.join(holds) if holds else '-', ':'.join(sorted(job.members))))
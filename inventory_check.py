@@ -0,0 +1,191 @@
+#!/usr/bin/env python
+
+# Checks a list of observations for complete inputs (uvfits and metafits)
+# and outputs (HEALPix cubes), in place of uvfits_check.sh and fhd_check.sh.
+# Each location is listed once and indexed by obsid and product, so every
+# obsid is checked with a lookup instead of a search through the whole
+# listing, and only exact file names count as present. Listings are cached
+# as manifests so repeated checks don't list the buckets again.
+#
+# Usage: inventory_check.py -f obs_list [-u uvfits_loc] [-m metafits_loc]
+#            [-d fhd_dir [-e even,odd] [-p XX,YY] [--min_size bytes]]
+#
+# The obs list has one obsid (or integrated subcube name) per line.
+# uvfits and metafits are checked unless --skip_inputs is given, and the
+# HEALPix cubes in fhd_dir/Healpix/ are checked if -d is given. Missing,
+# undersized and unexpected files are reported for every obsid in one pass.
+
+import os
+import re
+import sys
+import json
+import time
+import hashlib
+import optparse
+import object_store
+
+
+def list_location(location, cache_dir=None, max_age=3600., recursive=False):
+
+    # Sizes of the files directly under location (like aws s3 ls), or of all
+    # files under it if recursive, keyed by path relative to location.
+    # Listings younger than max_age seconds are read from a manifest in
+    # cache_dir instead.
+    location = location.rstrip('/') + '/'
+    manifest_filename = None
+    if cache_dir is not None:
+        manifest_filename = os.path.join(cache_dir, '{}.json'.format(
+            hashlib.sha1('{}{}'.format(
+                location, '**' if recursive else '').encode(
+                    'utf-8')).hexdigest()))
+        if os.path.isfile(manifest_filename):
+            manifest = json.load(open(manifest_filename))
+            if time.time() - manifest['listed'] < max_age:
+                return manifest['sizes']
+
+    store, prefix = object_store.split_url(location)
+    sizes = {}
+    for info in store.list(prefix):
+        name = info.key[len(prefix):]
+        if recursive or '/' not in name:
+            sizes[name] = info.size
+
+    if manifest_filename is not None:
+        if not os.path.isdir(cache_dir):
+            os.makedirs(cache_dir)
+        temp_filename = '{}.tmp'.format(manifest_filename)
+        manifest_file = open(temp_filename, 'w')
+        json.dump({'location': location, 'listed': time.time(),
+                   'sizes': sizes}, manifest_file)
+        manifest_file.close()
+        os.rename(temp_filename, manifest_filename)
+    return sizes
+
+
+def index_listing(sizes, products):
+
+    # Index file names of the form <obsid><product>, where product is one of
+    # the given suffixes, as {obsid: {product: size}}. Names that aren't any
+    # of the products are returned separately.
+    pattern = re.compile('^(.+?)({})$'.format('|'.join([
+        re.escape(product) for product in
+        sorted(products, key=len, reverse=True)])))
+    index = {}
+    unmatched = []
+    for name, size in sizes.items():
+        match = pattern.match(name)
+        if match is None:
+            unmatched.append(name)
+        else:
+            index.setdefault(match.group(1), {})[match.group(2)] = size
+    return index, sorted(unmatched)
+
+
+def check_inventory(index, unmatched, obs_list, products, min_size=1):
+
+    # Returns the obsids missing any of the products (with the products they
+    # are missing), the files smaller than min_size and the files that don't
+    # belong to an obsid in obs_list
+    missing = []
+    for obs in obs_list:
+        missing_products = [product for product in products
+                            if product not in index.get(obs, {})]
+        if len(missing_products) > 0:
+            missing.append((obs, missing_products))
+    undersized = sorted([
+        obs + product for obs in index
+        for product, size in index[obs].items() if size < min_size])
+    obs_set = set(obs_list)
+    unexpected = sorted(unmatched + [
+        obs + product for obs in index if obs not in obs_set
+        for product in index[obs]])
+    return missing, undersized, unexpected
+
+
+def print_check(label, missing, undersized, unexpected, products,
+                min_size, show_unexpected=False):
+
+    if len(missing) > 0:
+        print('Some {} are missing:'.format(label))
+        for obs, missing_products in missing:
+            if len(products) == 1:
+                print(obs)
+            else:
+                print('{} ({} of {} missing: {})'.format(
+                    obs, len(missing_products), len(products),
+                    ' '.join(missing_products)))
+    if len(undersized) > 0:
+        print('{} smaller than specified min_size ({} B):'.format(
+            label, min_size))
+        for name in undersized:
+            print(name)
+    if show_unexpected and len(unexpected) > 0:
+        print('{} files not in the obs list:'.format(label))
+        for name in unexpected:
+            print(name)
+
+
+def run_check(label, location, obs_list, products, min_size, cache_dir,
+              max_age, show_unexpected):
+
+    index, unmatched = index_listing(
+        list_location(location, cache_dir, max_age), products)
+    missing, undersized, unexpected = check_inventory(
+        index, unmatched, obs_list, products, min_size)
+    print_check(label, missing, undersized, unexpected, products, min_size,
+                show_unexpected)
+    return len(missing) + len(undersized)
+
+
+if __name__ == '__main__':
+    o = optparse.OptionParser(usage='%prog [options] -f obs_list')
+    o.add_option('-f', dest='check_list', type='str',
+                 help='Text file of obs ids or subcubes, one per line.')
+    o.add_option('-u', dest='s3_uvfits', type='str',
+                 default='s3://mwapublic/uvfits/4.1',
+                 help='uvfits location [default %default].')
+    o.add_option('-m', dest='s3_metafits', type='str',
+                 default='s3://mwatest/metafits/4.1',
+                 help='metafits location [default %default].')
+    o.add_option('-d', dest='fhd_dir', type='str',
+                 help='FHD directory to check the Healpix/ cubes of.')
+    o.add_option('-e', dest='evenodd', type='str', default='even,odd',
+                 help='Comma separated even-odd names [default %default].')
+    o.add_option('-p', dest='pol', type='str', default='XX,YY',
+                 help='Comma separated pol names [default %default].')
+    o.add_option('--min_size', type='int', default=4500000000,
+                 help='Min size of HEALPix cubes in B [default %default].')
+    o.add_option('--skip_inputs', action='store_true',
+                 help='Don\'t check the uvfits and metafits.')
+    o.add_option('--unexpected', action='store_true',
+                 help='Also list files for obsids not in the obs list.')
+    o.add_option('--cache_dir', type='str',
+                 default=os.path.expanduser('~/.inventory_cache'),
+                 help='Directory for cached listings [default %default].')
+    o.add_option('--max_age', type='float', default=3600.,
+                 help='Max age of cached listings in seconds, 0 to always '
+                      'list again [default %default].')
+    opts, args = o.parse_args(sys.argv[1:])
+    if opts.check_list is None:
+        o.error('Need to specify obs list file path with option -f')
+
+    obs_list = [line.strip() for line in open(opts.check_list)
+                if line.strip()]
+    n_problems = 0
+    if not opts.skip_inputs:
+        n_problems += run_check(
+            'uvfits', opts.s3_uvfits, obs_list, ['.uvfits'], 1,
+            opts.cache_dir, opts.max_age, opts.unexpected)
+        n_problems += run_check(
+            'metafits', opts.s3_metafits, obs_list, ['.metafits'], 1,
+            opts.cache_dir, opts.max_age, opts.unexpected)
+    if opts.fhd_dir is not None:
+        cube_products = [
+            '_{}_cube{}.sav'.format(evenodd, pol)
+            for evenodd in opts.evenodd.split(',')
+            for pol in opts.pol.split(',')]
+        n_problems += run_check(
+            'HEALPix cubes', opts.fhd_dir.rstrip('/') + '/Healpix',
+            obs_list, cube_products, opts.min_size, opts.cache_dir,
+            opts.max_age, opts.unexpected)
+    sys.exit(1 if n_problems > 0 else 0)
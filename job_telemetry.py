@@ -0,0 +1,257 @@
+#!/usr/bin/env python
+
+# Collects the grid engine stdout logs that fhd_job_aws.sh uploads to
+# fhd_<version>/grid_out/ into a per-job table and reports where the
+# instance hours go: throughput per version, runtime percentiles for each
+# phase of the job, per-node utilization and straggling jobs.
+# The table can also be written out as a runtime history for
+# pull_args.py --history.
+#
+# Usage: job_telemetry.py [--table jobs.npy] [--history runtimes.txt]
+#            s3://mwatest/diffuse_survey/fhd_<version>/grid_out/ [...]
+
+import re
+import sys
+import optparse
+from datetime import datetime
+from multiprocessing.pool import ThreadPool
+import numpy as np
+import object_store
+
+job_dtype = np.dtype([
+    ('job_id', np.int64), ('task_id', np.int64), ('obsid', np.int64),
+    ('version', 'S64'), ('ip', 'S15'), ('instance_id', 'S19'),
+    ('start', float), ('end', float),
+    ('download_start', float), ('download_end', float),
+    ('idl_start', float), ('idl_end', float),
+    ('upload_start', float), ('upload_end', float),
+    ('spot_termination', float),
+    ('upload_retries', np.int32), ('spot_terminated', bool),
+    ('finished', bool)])
+
+# Log lines written by fhd_job_aws.sh and checkpoint_uploader.py, and the
+# table columns they fill
+time_lines = {
+    'JOB START TIME': 'start', 'JOB END TIME': 'end',
+    'DOWNLOAD START TIME': 'download_start',
+    'DOWNLOAD END TIME': 'download_end',
+    'IDL START TIME': 'idl_start', 'IDL END TIME': 'idl_end',
+    'UPLOAD START TIME': 'upload_start', 'UPLOAD END TIME': 'upload_end',
+    'SPOT TERMINATION TIME': 'spot_termination'}
+value_lines = {
+    'JOBID': 'job_id', 'TASKID': 'task_id', 'OBSID': 'obsid',
+    'VERSION': 'version', 'PUBLIC IP': 'ip', 'INSTANCE ID': 'instance_id'}
+epoch = datetime(1970, 1, 1)
+
+
+def parse_job_log(log_text, version=''):
+
+    # One row of job_dtype from the text of a job's stdout log. Times are in
+    # seconds since the epoch and are NaN for phases the log doesn't record.
+    job = np.zeros(1, dtype=job_dtype)[0]
+    for field in time_lines.values():
+        job[field] = np.nan
+    job['version'] = version
+    job['task_id'] = -1
+    for line in log_text.splitlines():
+        line = line.strip()
+        if line == 'FHD Job Finished':
+            job['finished'] = True
+        elif line.startswith(('Spot instance termination notice sent',
+                              'SPOT TERMINATION TIME')):
+            # The time of the notice is read into spot_termination below;
+            # some logs have only the first line
+            job['spot_terminated'] = True
+        elif line.startswith('UPLOAD ATTEMPTS'):
+            job['upload_retries'] = int(line.split()[-1]) - 1
+        for label, field in time_lines.items():
+            if line.startswith(label + ' '):
+                job[field] = (datetime.strptime(
+                    line[len(label):].strip(), '%Y-%m-%d_%H:%M:%S')
+                    - epoch).total_seconds()
+        for label, field in value_lines.items():
+            if line.startswith(label + ' ') and line[len(label):].strip():
+                try:
+                    job[field] = line[len(label):].strip()
+                except ValueError:
+                    pass
+    return job
+
+
+def collect_logs(locations, nworkers=16):
+
+    # Read every fhd_job_aws.sh stdout log under the given S3 prefixes or
+    # local directories into a table, fetching nworkers logs at a time
+    log_keys = []
+    for location in locations:
+        store, prefix = object_store.split_url(location.rstrip('/') + '/')
+        log_keys.extend([
+            (store, log.key) for log in store.list(prefix)
+            if re.search(r'fhd_job_aws\.sh\.o[0-9]+', log.key)])
+
+    def read_log(store_key):
+        store, key = store_key
+        log_file = store.open(key)
+        try:
+            log_text = log_file.read()
+        finally:
+            log_file.close()
+        if not isinstance(log_text, str):
+            log_text = log_text.decode('utf-8', 'replace')
+        version = re.search(r'fhd_([^/]+)/grid_out/', store.url(key))
+        return log_text, version.group(1) if version else ''
+
+    # Only the reads are threaded; strptime isn't safe to first call from
+    # several threads at once in python 2
+    pool = ThreadPool(nworkers)
+    try:
+        logs = pool.map(read_log, log_keys)
+    finally:
+        pool.close()
+        pool.join()
+    return np.array([parse_job_log(log_text, version)
+                     for log_text, version in logs], dtype=job_dtype)
+
+
+def get_phase_durations(jobs):
+
+    # Duration in hours of each job and of each of its phases
+    return {
+        'total': (jobs['end'] - jobs['start'])/3600.,
+        'download': (jobs['download_end'] - jobs['download_start'])/3600.,
+        'idl': (jobs['idl_end'] - jobs['idl_start'])/3600.,
+        'upload': (jobs['upload_end'] - jobs['upload_start'])/3600.}
+
+
+def get_version_throughput(jobs):
+
+    # Per version: number of jobs, number finished, wall-clock span in hours
+    # and finished jobs per hour of span
+    report = []
+    for version in np.unique(jobs['version']):
+        version_jobs = jobs[jobs['version'] == version]
+        span = (np.nanmax(version_jobs['end'])
+                - np.nanmin(version_jobs['start']))/3600.
+        n_finished = np.count_nonzero(version_jobs['finished'])
+        report.append((version, len(version_jobs), n_finished, span,
+                       n_finished/span if span > 0 else np.nan))
+    return report
+
+
+def get_runtime_percentiles(jobs, percentiles=(50, 90, 99)):
+
+    # Percentiles of each phase's duration in hours, ignoring jobs that
+    # don't record that phase
+    report = {}
+    for phase, durations in get_phase_durations(jobs).items():
+        durations = durations[np.isfinite(durations)]
+        if len(durations) > 0:
+            report[phase] = np.percentile(durations, percentiles)
+        else:
+            report[phase] = np.full(len(percentiles), np.nan)
+    return report
+
+
+def get_node_utilization(jobs):
+
+    # Per node (public IP): number of jobs, hours with at least one job
+    # running, hours between its first job starting and last job ending,
+    # and the fraction of that span it was busy
+    report = []
+    timed = jobs[np.isfinite(jobs['start']) & np.isfinite(jobs['end'])]
+    for ip in np.unique(timed['ip']):
+        node_jobs = timed[timed['ip'] == ip]
+        order = np.argsort(node_jobs['start'])
+        starts = node_jobs['start'][order]
+        # Union of the jobs' intervals: an interval starts a new busy period
+        # if it begins after every earlier job has ended
+        ends = np.maximum.accumulate(node_jobs['end'][order])
+        new_period = np.r_[True, starts[1:] > ends[:-1]]
+        period_ends = np.r_[ends[np.flatnonzero(new_period)[1:] - 1],
+                            ends[-1]]
+        busy = np.sum(period_ends - starts[new_period])/3600.
+        span = (ends[-1] - starts[0])/3600.
+        report.append((ip, len(node_jobs), busy, span,
+                       busy/span if span > 0 else np.nan))
+    return report
+
+
+def get_stragglers(jobs, factor=2.):
+
+    # Jobs that took more than factor times the median runtime of their
+    # version
+    durations = get_phase_durations(jobs)['total']
+    straggler = np.zeros(len(jobs), dtype=bool)
+    for version in np.unique(jobs['version']):
+        in_version = (jobs['version'] == version) & np.isfinite(durations)
+        if np.any(in_version):
+            straggler[in_version] = (
+                durations[in_version]
+                > factor*np.median(durations[in_version]))
+    return jobs[straggler], durations[straggler]
+
+
+def write_history(jobs, history_filename):
+
+    # One "obsid runtime_seconds" line per finished job, in the format read
+    # by pull_args.py --history
+    finished = jobs[jobs['finished'] & np.isfinite(jobs['idl_end'])
+                    & np.isfinite(jobs['idl_start'])]
+    history_file = open(history_filename, 'w')
+    for job in finished:
+        history_file.write('{} {:.0f}\n'.format(
+            job['obsid'], job['idl_end'] - job['idl_start']))
+    history_file.close()
+
+
+def print_report(jobs, straggler_factor=2.):
+
+    print('{} jobs, {} finished, {} spot terminations, {} upload '
+          'retries'.format(
+              len(jobs), np.count_nonzero(jobs['finished']),
+              np.count_nonzero(jobs['spot_terminated']),
+              np.sum(jobs['upload_retries'])))
+
+    print('\nThroughput per version:')
+    for version, n_jobs, n_finished, span, throughput in \
+            get_version_throughput(jobs):
+        print('  {}: {} jobs, {} finished in {:.1f} h ({:.2f} jobs/h)'.format(
+            version, n_jobs, n_finished, span, throughput))
+
+    print('\nRuntime percentiles (hours; p50, p90, p99):')
+    for phase, values in sorted(get_runtime_percentiles(jobs).items()):
+        print('  {}: {}'.format(
+            phase, ', '.join(['{:.2f}'.format(value) for value in values])))
+
+    print('\nNode utilization:')
+    for ip, n_jobs, busy, span, utilization in get_node_utilization(jobs):
+        print('  {}: {} jobs, busy {:.1f} of {:.1f} h ({:.0%})'.format(
+            ip, n_jobs, busy, span, utilization))
+
+    stragglers, durations = get_stragglers(jobs, straggler_factor)
+    print('\nStragglers (over {}x the median runtime of their '
+          'version):'.format(straggler_factor))
+    for job, duration in zip(stragglers, durations):
+        print('  obsid {} job {} on {}: {:.2f} h'.format(
+            job['obsid'], job['job_id'], job['ip'], duration))
+
+
+if __name__ == '__main__':
+    o = optparse.OptionParser(usage='%prog [options] log_location [...]')
+    o.add_option('--table', type='str',
+                 help='Save the per-job table to this .npy file.')
+    o.add_option('--history', type='str',
+                 help='Write IDL runtimes per obsid to this file for '
+                      'pull_args.py --history.')
+    o.add_option('--straggler_factor', type='float', default=2.,
+                 help='Report jobs slower than this multiple of the median.')
+    opts, args = o.parse_args(sys.argv[1:])
+    if len(args) == 0:
+        o.error('Specify at least one log location.')
+
+    jobs = collect_logs(args)
+    if opts.table is not None:
+        np.save(opts.table, jobs)
+    if opts.history is not None:
+        write_history(jobs, opts.history)
+    print_report(jobs, opts.straggler_factor)
@@ -0,0 +1,379 @@
+#!/usr/bin/env python
+
+# Small storage layer used by the scripts in this repo in place of calling
+# the aws command line tools. Objects are addressed by URL, e.g.
+# s3://eorbilling//cost_report/..., and each bucket is served by either an S3
+# backend (needs boto3) or a local directory backend for offline use and
+# testing.
+# The S3 backend needs boto3 in the python that runs the scripts (conda
+# install boto3): the miniconda2 python on the cluster nodes, set up by
+# cfncluster_pre_install.sh, and the python aws_costs_cron.sh runs on the
+# cron host. Credentials are read the same way as by the aws command line
+# tools (aws configure). Where boto3 isn't installed (e.g. nodes built from
+# images made before it was added), S3 is accessed by running the aws
+# command line tools instead, which is slower but needs nothing new. The
+# AWS_CLI environment variable gives the aws executable to run (default:
+# aws from the PATH), for hosts like the cost cron's where it isn't on the
+# PATH.
+# Setting the OBJECT_STORE_ROOT environment variable to a directory makes
+# s3://bucket/key resolve to OBJECT_STORE_ROOT/bucket/key instead of S3.
+
+import os
+import sys
+import json
+import time
+import shutil
+import subprocess
+from datetime import datetime
+from multiprocessing.pool import ThreadPool
+
+try:
+    import boto3
+except ImportError:
+    boto3 = None
+
+_stores = {}
+
+
+class ObjectInfo:
+
+    def __init__(self, key, size, last_modified):
+        self.key = key
+        self.size = int(size)
+        self.last_modified = last_modified  # naive datetime in UTC
+
+
+class LocalStore:
+
+    # Bucket stored as a directory tree; keys are paths relative to root.
+    # S3 keys can start with a slash (AWS writes the cost reports under
+    # s3://eorbilling//cost_report/), which is dropped in the tree but kept
+    # in the keys listed under such a prefix.
+
+    def __init__(self, root):
+        self.root = os.path.abspath(root)
+
+    def path(self, key):
+        return os.path.join(self.root, key.lstrip('/'))
+
+    def url(self, key):
+        return self.path(key)
+
+    def stat(self, key):
+        filename = self.path(key)
+        if not os.path.isfile(filename):
+            return None
+        file_stat = os.stat(filename)
+        return ObjectInfo(key, file_stat.st_size,
+                          datetime.utcfromtimestamp(file_stat.st_mtime))
+
+    def list(self, prefix=''):
+        # Walk only the part of the tree that can contain the prefix
+        stripped_prefix = prefix.lstrip('/')
+        leading = prefix[:len(prefix) - len(stripped_prefix)]
+        prefix_dir = os.path.join(
+            self.root, os.path.dirname(stripped_prefix))
+        keys = []
+        for dirpath, dirnames, filenames in os.walk(prefix_dir):
+            for filename in filenames:
+                key = os.path.relpath(
+                    os.path.join(dirpath, filename), self.root)
+                key = key.replace(os.sep, '/')
+                if key.startswith(stripped_prefix):
+                    keys.append(leading + key)
+        for key in sorted(keys):
+            yield self.stat(key)
+
+    def open(self, key):
+        return open(self.path(key), 'rb')
+
+    def download(self, key, filename):
+        temp_filename = '{}.download'.format(filename)
+        shutil.copyfile(self.path(key), temp_filename)
+        os.rename(temp_filename, filename)
+
+    def upload(self, filename, key):
+        destination = self.path(key)
+        if not os.path.isdir(os.path.dirname(destination)):
+            os.makedirs(os.path.dirname(destination))
+        temp_destination = '{}.upload'.format(destination)
+        shutil.copyfile(filename, temp_destination)
+        os.rename(temp_destination, destination)
+
+    def delete(self, key):
+        os.remove(self.path(key))
+
+
+class S3Store:
+
+    # One boto3 client per bucket, so its connection pool is reused by every
+    # request made through the store
+
+    def __init__(self, bucket):
+        if boto3 is None:
+            raise ImportError('boto3 is required to access S3 buckets '
+                              '(conda install boto3).')
+        self.bucket = bucket
+        self.client = boto3.client('s3')
+
+    def __getstate__(self):
+        # boto3 clients can't be pickled, so a store sent to a worker process
+        # opens its own client there
+        return {'bucket': self.bucket}
+
+    def __setstate__(self, state):
+        self.__init__(state['bucket'])
+
+    def url(self, key):
+        return 's3://{}/{}'.format(self.bucket, key)
+
+    def stat(self, key):
+        try:
+            response = self.client.head_object(Bucket=self.bucket, Key=key)
+        except self.client.exceptions.ClientError as error:
+            if error.response['Error']['Code'] in ['404', 'NoSuchKey']:
+                return None
+            raise
+        return ObjectInfo(key, response['ContentLength'],
+                          response['LastModified'].replace(tzinfo=None))
+
+    def list(self, prefix=''):
+        paginator = self.client.get_paginator('list_objects_v2')
+        for page in paginator.paginate(Bucket=self.bucket, Prefix=prefix):
+            for obj in page.get('Contents', []):
+                yield ObjectInfo(obj['Key'], obj['Size'],
+                                 obj['LastModified'].replace(tzinfo=None))
+
+    def open(self, key):
+        return self.client.get_object(Bucket=self.bucket, Key=key)['Body']
+
+    def download(self, key, filename):
+        temp_filename = '{}.download'.format(filename)
+        self.client.download_file(self.bucket, key, temp_filename)
+        os.rename(temp_filename, filename)
+
+    def upload(self, filename, key):
+        self.client.upload_file(filename, self.bucket, key)
+
+    def delete(self, key):
+        self.client.delete_object(Bucket=self.bucket, Key=key)
+
+
+class AwsCliStream:
+
+    # Read-only stream of an object piped from aws s3 cp. Errors are raised
+    # on close if the stream was read to the end; closing it early just
+    # stops the transfer.
+
+    def __init__(self, url, aws_cli='aws'):
+        self.url = url
+        self.at_end = False
+        self.process = subprocess.Popen(
+            [aws_cli, 's3', 'cp', url, '-'], stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE)
+
+    def read(self, size=-1):
+        data = self.process.stdout.read(size)
+        if size < 0 or not data:
+            self.at_end = True
+        return data
+
+    def close(self):
+        if not self.at_end:
+            self.process.kill()
+        self.process.stdout.close()
+        error = self.process.stderr.read()
+        self.process.stderr.close()
+        if self.process.wait() != 0 and self.at_end:
+            raise IOError('Reading {} failed: {}'.format(
+                self.url, error.decode('utf-8', 'replace').strip()))
+
+
+class AwsCliStore:
+
+    # S3 bucket accessed through the aws command line tools, for when boto3
+    # isn't installed. aws_cli defaults to the AWS_CLI environment variable,
+    # or aws from the PATH.
+
+    def __init__(self, bucket, aws_cli=None):
+        self.bucket = bucket
+        if aws_cli is None:
+            aws_cli = os.environ.get('AWS_CLI', 'aws')
+        self.aws_cli = aws_cli
+
+    def url(self, key):
+        return 's3://{}/{}'.format(self.bucket, key)
+
+    def run(self, args):
+        process = subprocess.Popen(
+            [self.aws_cli] + args, stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE)
+        output, error = process.communicate()
+        if not isinstance(output, str):
+            output = output.decode('utf-8')
+            error = error.decode('utf-8', 'replace')
+        return process.returncode, output, error
+
+    def check_run(self, args):
+        returncode, output, error = self.run(args)
+        if returncode != 0:
+            raise IOError('aws {} failed: {}'.format(
+                ' '.join(args), error.strip()))
+        return output
+
+    def stat(self, key):
+        returncode, output, error = self.run(
+            ['s3api', 'head-object', '--bucket', self.bucket, '--key', key,
+             '--output', 'json'])
+        if returncode != 0:
+            if '(404)' in error or 'Not Found' in error:
+                return None
+            raise IOError('aws s3api head-object {} failed: {}'.format(
+                self.url(key), error.strip()))
+        response = json.loads(output)
+        return ObjectInfo(key, response['ContentLength'],
+                          parse_cli_time(response['LastModified']))
+
+    def list(self, prefix=''):
+        # The aws command line tools follow the pagination themselves
+        output = self.check_run(
+            ['s3api', 'list-objects-v2', '--bucket', self.bucket, '--prefix',
+             prefix, '--output', 'json'])
+        if not output.strip():
+            return
+        for obj in json.loads(output).get('Contents') or []:
+            yield ObjectInfo(obj['Key'], obj['Size'],
+                             parse_cli_time(obj['LastModified']))
+
+    def open(self, key):
+        return AwsCliStream(self.url(key), self.aws_cli)
+
+    def download(self, key, filename):
+        temp_filename = '{}.download'.format(filename)
+        self.check_run(['s3', 'cp', '--only-show-errors', self.url(key),
+                        temp_filename])
+        os.rename(temp_filename, filename)
+
+    def upload(self, filename, key):
+        self.check_run(['s3', 'cp', '--only-show-errors', filename,
+                        self.url(key)])
+
+    def delete(self, key):
+        self.check_run(['s3', 'rm', '--only-show-errors', self.url(key)])
+
+
+def parse_cli_time(text):
+
+    # Times printed by the aws command line tools as naive UTC datetimes. The
+    # format depends on the command and the version of the tools.
+    for time_format in ['%Y-%m-%dT%H:%M:%S.%fZ', '%Y-%m-%dT%H:%M:%SZ',
+                        '%Y-%m-%dT%H:%M:%S+00:00',
+                        '%a, %d %b %Y %H:%M:%S GMT']:
+        try:
+            return datetime.strptime(text, time_format)
+        except ValueError:
+            pass
+    raise ValueError('Unrecognized time {} from the aws command line '
+                     'tools.'.format(text))
+
+
+def get_store(bucket_url):
+
+    # bucket_url is s3://bucket or a local directory. Stores are created once
+    # per bucket and shared.
+    if bucket_url not in _stores:
+        if bucket_url.startswith('s3://'):
+            bucket = bucket_url[len('s3://'):].strip('/')
+            local_root = os.environ.get('OBJECT_STORE_ROOT')
+            if local_root:
+                _stores[bucket_url] = LocalStore(
+                    os.path.join(local_root, bucket))
+            elif boto3 is not None:
+                _stores[bucket_url] = S3Store(bucket)
+            else:
+                _stores[bucket_url] = AwsCliStore(bucket)
+        else:
+            _stores[bucket_url] = LocalStore(bucket_url)
+    return _stores[bucket_url]
+
+
+def split_url(url):
+
+    # Split s3://bucket/key/path into the store for the bucket and the key.
+    # Local paths are split at the last directory.
+    if url.startswith('s3://'):
+        bucket, _, key = url[len('s3://'):].partition('/')
+        return get_store('s3://{}'.format(bucket)), key
+    return get_store(os.path.dirname(url)), os.path.basename(url)
+
+
+def fetch(store, key, filename, retries=5, backoff=1.):
+
+    # Download key to filename unless a file of the right size is already
+    # there. Failed downloads are retried, waiting backoff*2**attempt seconds
+    # between attempts. Returns True if the file was downloaded.
+    info = store.stat(key)
+    if info is None:
+        raise IOError('{} not found.'.format(store.url(key)))
+    if os.path.isfile(filename) and os.path.getsize(filename) == info.size:
+        return False
+    for attempt in range(retries):
+        try:
+            store.download(key, filename)
+            if os.path.getsize(filename) != info.size:
+                raise IOError('{} is {} bytes, expected {}.'.format(
+                    filename, os.path.getsize(filename), info.size))
+            return True
+        except Exception as error:
+            if attempt == retries - 1:
+                raise
+            sys.stderr.write(
+                'Downloading {} failed ({}). Retrying (attempt {}).\n'.format(
+                    store.url(key), error, attempt + 2))
+            time.sleep(backoff*2**attempt)
+
+
+def push(store, filename, key, retries=5, backoff=1.):
+
+    # Upload filename to key, retrying failed uploads like fetch does
+    for attempt in range(retries):
+        try:
+            store.upload(filename, key)
+            return
+        except Exception as error:
+            if attempt == retries - 1:
+                raise
+            sys.stderr.write(
+                'Uploading {} failed ({}). Retrying (attempt {}).\n'.format(
+                    store.url(key), error, attempt + 2))
+            time.sleep(backoff*2**attempt)
+
+
+def prefetch(store, downloads, nworkers=8, retries=5, backoff=1.):
+
+    # Download a list of (key, filename) pairs with nworkers concurrent
+    # transfers, yielding each pair as soon as its file is in place so it can
+    # be processed while the rest are still downloading. Files that are
+    # already present are not downloaded again, so an interrupted prefetch
+    # can simply be rerun. Downloads that still fail after retries are
+    # reported and skipped.
+    def fetch_download(download):
+        key, filename = download
+        try:
+            fetch(store, key, filename, retries=retries, backoff=backoff)
+        except Exception as error:
+            return key, filename, error
+        return key, filename, None
+
+    pool = ThreadPool(nworkers)
+    try:
+        for key, filename, error in pool.imap_unordered(
+                fetch_download, downloads):
+            if error is None:
+                yield key, filename
+            else:
+                sys.stderr.write('ERROR: downloading {} failed: {}\n'.format(
+                    store.url(key), error))
+    finally:
+        pool.close()
+        pool.join()
@@ -8,10 +8,10 @@ matplotlib.use('Agg')
 import matplotlib.pyplot as plt
 import matplotlib as mpl
 import os
-from matplotlib.patches import Polygon
-from matplotlib.collections import PatchCollection
-import sys
+import multiprocessing
+from matplotlib.collections import PolyCollection
 import surveyview
+import object_store
 
 
 obsids = [1131478056, 1131564464, 1131477936, 1130787784, 1131477816,
@@ -29,14 +29,27 @@ obsids = [1131478056, 1131564464, 1131477936, 1130787784, 1131477816,
           1131535544, 1131535424, 1131535304, 1131710032, 1131709912]
 
 
-def download_data():
+def download_data(data_dir='/Healpix_fits', nworkers=8):
 
-    obs_to_download = list(set(obsids))
-    for obs in obs_to_download:
-        os.system('aws s3 cp s3://mwatest/diffuse_survey/fhd_rlb_GLEAM+Fornax_cal_decon_Nov2016/output_data/{}_uniform_Residual_I_HEALPix.fits /Healpix_fits/{}_uniform_Residual_I_HEALPix.fits'.format(obs, obs))
+    for data_filename in prefetch_maps(list(set(obsids)), data_dir, nworkers=nworkers):
+        print('Downloaded {}.'.format(data_filename))
 
 
-def plot_healpix_tiling():
+def prefetch_maps(obs_list, data_dir, normalization='uniform',
+                  data_type='Residual_I', nworkers=8):
+
+    # Yield the local filename of each observation's map as soon as it has
+    # been downloaded (or immediately if it was already there)
+    if not os.path.isdir(data_dir):
+        os.makedirs(data_dir)
+    store = object_store.get_store('s3://mwatest')
+    downloads = [('diffuse_survey/fhd_rlb_GLEAM+Fornax_cal_decon_Nov2016/output_data/{}_{}_{}_HEALPix.fits'.format(obs, normalization, data_type), '{}/{}_{}_{}_HEALPix.fits'.format(data_dir, obs, normalization, data_type)) for obs in obs_list]
+    for key, data_filename in object_store.prefetch(store, downloads, nworkers=nworkers):
+        yield data_filename
+
+
+def plot_healpix_tiling(nprocs=multiprocessing.cpu_count(), render='raster',
+                        mosaic_filename=None):
 
     data_type = 'Residual_I'
     normalization = 'uniform'
@@ -77,36 +90,89 @@ def plot_healpix_tiling():
     #          1131477816, 1131731632, 1130778424, 1131463296, 1131459576,
     #          1131713512, 1131709912]
 
-    data = []
+    print('Gathering pixels from {} obsids.'.format(len(obsids)))
+    obs_tiles = {}
     for i, obs in enumerate(obsids):
-        print 'Gathering pixels from obsid {} of {}.'.format(i+1, len(obsids))
-        obs_data, nside, nest = load_map('{}/{}_{}_{}_HEALPix.fits'.format(data_dir, obs, normalization, data_type))
-        tile_bounds_radec = [[tile_center_ras[i]-5, tile_center_decs[i]-5],
-                             [tile_center_ras[i]-5, tile_center_decs[i]+5],
-                             [tile_center_ras[i]+5, tile_center_decs[i]+5],
-                             [tile_center_ras[i]+5, tile_center_decs[i]-5]]
-        tile_bounds_vec = np.array([hp.pixelfunc.ang2vec(corner[0], corner[1], lonlat=True) for corner in tile_bounds_radec])
-        use_pixels = hp.query_polygon(nside, tile_bounds_vec, nest=nest)
-        data.extend([data_point for data_point in obs_data if data_point.pixelnum in use_pixels])
-
-    # Collect Healpix pixels to plot
-    print 'Gathering pixel corners.'
-    patches = []
-    colors = []
-    for point in data:
-        point.get_pixel_corners(nside, nest)
-        polygon = Polygon(zip(point.pix_corner_ras, point.pix_corner_decs))
-        patches.append(polygon)
-        colors.append(point.signal)
-
-    print 'Plotting.'
-    collection = PatchCollection(patches, cmap='Greys_r', lw=0.04)
-    collection.set_array(np.array(colors))  # set the data colors
-    collection.set_clim(vmin=-.035, vmax=.035)  # set the colorbar min and max
-    collection.set_edgecolor('face')  # make the face and edge colors match
-
-    fig, ax = plt.subplots(figsize=(24, 8), dpi=1000)
-    ax.add_collection(collection)  # plot data
+        data_filename = '{}/{}_{}_{}_HEALPix.fits'.format(data_dir, obs, normalization, data_type)
+        obs_tiles.setdefault(data_filename, []).append((tile_center_ras[i], tile_center_decs[i]))
+
+    # Each map is handed to the tiling workers as soon as it has downloaded,
+    # and tiles are streamed into the mosaic as the workers finish them, so
+    # downloading and processing overlap and only the combined map is held
+    # in memory
+    def iter_tile_args():
+        for data_filename in prefetch_maps(list(set(obsids)), data_dir, normalization, data_type):
+            for tile_center in obs_tiles[data_filename]:
+                yield (data_filename, tile_center[0], tile_center[1])
+
+    mosaic = HealpixMosaic()
+    pool = multiprocessing.Pool(nprocs)
+    try:
+        for tile in pool.imap_unordered(load_tile, iter_tile_args()):
+            mosaic.add(tile)
+    finally:
+        pool.close()
+        pool.join()
+    mosaic_map = mosaic.get_map()
+    if mosaic_filename is not None:
+        mosaic.write(mosaic_filename)
+
+    plot_mosaic(mosaic_map.pixelnums, mosaic_map.signal, mosaic_map.nside, mosaic_map.nest, '/home/ubuntu/MWA/mosaicplot.png', render=render)
+
+    object_store.get_store('s3://mwatest').upload(
+        '/home/ubuntu/MWA/mosaicplot.png', 'diffuse_survey/mosaicplot.png')
+
+
+def mosaic_observations(data_filenames, output_filename, weights=None,
+                        tile_centers=None):
+
+    # Combine many observations' maps into one weighted-average map written
+    # to output_filename. Maps are read one at a time, so memory depends on
+    # the sky area covered rather than on the number of observations.
+    # weights gives one weight per observation and tile_centers an optional
+    # (RA, Dec) tile to keep from each observation.
+    mosaic = HealpixMosaic()
+    for i, data_filename in enumerate(data_filenames):
+        print('Adding observation {} of {}.'.format(i+1, len(data_filenames)))
+        healpix_map = load_map(data_filename)
+        if tile_centers is not None:
+            healpix_map = select_tile_pixels(
+                healpix_map, tile_centers[i][0], tile_centers[i][1])
+        if weights is None:
+            mosaic.add(healpix_map)
+        else:
+            mosaic.add(healpix_map, weights[i])
+    mosaic.write(output_filename)
+    return mosaic.get_map()
+
+
+def plot_mosaic(pixelnums, signal, nside, nest, plot_filename,
+                render='raster', dpi=1000):
+
+    # render='raster' resamples the pixels onto a regular RA/Dec grid and
+    # draws it as an image. render='polygon' draws every HEALPix pixel as a
+    # polygon, which is exact but much slower and more memory hungry.
+    fig, ax = plt.subplots(figsize=(24, 8), dpi=dpi)
+    if render == 'raster':
+        print('Rasterizing pixels.')
+        raster, extent = rasterize_pixels(pixelnums, signal, nside, nest)
+        cmap = plt.get_cmap('Greys_r')
+        cmap.set_bad(alpha=0)  # let the background show through empty cells
+        plot_data = ax.imshow(
+            raster, cmap=cmap, extent=extent, origin='lower',
+            interpolation='nearest', vmin=-.035, vmax=.035)
+    elif render == 'polygon':
+        print('Gathering pixel corners.')
+        corner_ras, corner_decs = get_pixel_corners(pixelnums, nside, nest)
+        plot_data = PolyCollection(
+            np.stack((corner_ras, corner_decs), axis=-1), cmap='Greys_r',
+            lw=0.04)
+        plot_data.set_array(np.asarray(signal))  # set the data colors
+        plot_data.set_clim(vmin=-.035, vmax=.035)  # set the colorbar min and max
+        plot_data.set_edgecolor('face')  # make the face and edge colors match
+        ax.add_collection(plot_data)  # plot data
+    else:
+        raise ValueError('render must be "raster" or "polygon".')
 
     # plot lines between tiles
     line_width = 2
@@ -135,45 +201,251 @@ def plot_healpix_tiling():
     plt.axis('equal')
     ax.set_facecolor('gray')  # make plot background gray
     plt.axis([110, -30, -50, 0])
-    cbar = fig.colorbar(collection, ax=ax, extend='both')  # add colorbar
+    cbar = fig.colorbar(plot_data, ax=ax, extend='both')  # add colorbar
     cbar.ax.set_ylabel('Flux Density (Jy/sr)', rotation=270)  # label colorbar
 
-    plt.savefig('/home/ubuntu/MWA/mosaicplot.png', format='png', dpi=1000)
-
-    os.system('aws s3 cp /home/ubuntu/MWA/mosaicplot.png s3://mwatest/diffuse_survey/mosaicplot.png')
-
-
-def load_map(data_filename):
-
-    contents = fits.open(data_filename)
-    nside = int(contents[1].header['nside'])
-    ordering = contents[1].header['ordering']
-    data = contents[1].data
-    contents.close()
-
-    pixel_vals = data.field('PIXEL')
-    signal_vals = data.field('SIGNAL')
+    plt.savefig(plot_filename, format='png', dpi=dpi)
+    plt.close(fig)
+
+
+def rasterize_pixels(pixelnums, signal, nside, nest, oversample=2,
+                     batch_size=1000000):
+
+    # Sample the map on a regular RA/Dec grid with cells oversample times
+    # finer than the HEALPix pixels. The grid's extent is reduced over
+    # batches of pixel corners, and grid cells are looked up in batches of
+    # rows, so neither is held for the whole map at once. Cells outside the
+    # selected pixels are masked. Where a pixel number appears more than once
+    # the last value is used, matching the drawing order of the polygon
+    # renderer.
+    pixelnums = np.asarray(pixelnums)
+    signal = np.asarray(signal)
+    last_inds = len(pixelnums) - 1 - np.unique(
+        pixelnums[::-1], return_index=True)[1]
+    sorted_pixels = pixelnums[last_inds]
+    sorted_signal = signal[last_inds]
+
+    ra_min, ra_max, dec_min, dec_max = np.inf, -np.inf, np.inf, -np.inf
+    pixels_per_batch = max(batch_size//4, 1)  # 4 corners per pixel
+    for start in range(0, len(sorted_pixels), pixels_per_batch):
+        corner_ras, corner_decs = get_pixel_corners(
+            sorted_pixels[start:start+pixels_per_batch], nside, nest)
+        ra_min = min(ra_min, np.min(corner_ras))
+        ra_max = max(ra_max, np.max(corner_ras))
+        dec_min = min(dec_min, np.min(corner_decs))
+        dec_max = max(dec_max, np.max(corner_decs))
+    cell_size = hp.nside2resol(nside, arcmin=True)/60./oversample
+    ras = np.arange(ra_min + cell_size/2, ra_max, cell_size)
+    decs = np.arange(dec_min + cell_size/2, dec_max, cell_size)
+
+    raster = np.full((len(decs), len(ras)), np.nan)
+    rows_per_batch = max(batch_size//len(ras), 1)
+    for start in range(0, len(decs), rows_per_batch):
+        batch_ras, batch_decs = np.meshgrid(
+            ras, decs[start:start+rows_per_batch])
+        cell_pixels = hp.ang2pix(nside, np.mod(batch_ras, 360.), batch_decs,
+                                 nest=nest, lonlat=True)
+        inds = np.searchsorted(sorted_pixels, cell_pixels)
+        inds[inds == len(sorted_pixels)] = 0
+        found = sorted_pixels[inds] == cell_pixels
+        raster[start:start+rows_per_batch][found] = sorted_signal[inds[found]]
+
+    extent = (ras[0] - cell_size/2, ras[-1] + cell_size/2,
+              decs[0] - cell_size/2, decs[-1] + cell_size/2)
+    return np.ma.masked_invalid(raster), extent
+
+
+def get_pixel_corners(pixelnums, nside, nest):
+
+    # RA and Dec of the corners of each pixel, shape (npixels, 4), computed
+    # for all pixels at once. RAs above 270 are wrapped to negative values.
+    pixelnums = np.atleast_1d(pixelnums)
+    coords = hp.boundaries(nside, pixelnums, step=1, nest=nest)
+    coords = np.reshape(coords, (len(pixelnums), 3, 4))
+    ras, decs = hp.pixelfunc.vec2ang(
+        np.transpose(coords, (0, 2, 1)).reshape(-1, 3), lonlat=True)
+    ras[ras > 270] -= 360.
+    return ras.reshape(-1, 4), decs.reshape(-1, 4)
+
+
+def load_tile(args):
+
+    # Load one observation's map and keep only the pixels in its tile. Used
+    # as a worker function, so takes its arguments as a single tuple.
+    data_filename, tile_center_ra, tile_center_dec = args
+    return select_tile_pixels(
+        load_map(data_filename), tile_center_ra, tile_center_dec)
+
+
+def select_tile_pixels(healpix_map, tile_center_ra, tile_center_dec,
+                       tile_size=10.):
+
+    tile_bounds_radec = [
+        [tile_center_ra-tile_size/2, tile_center_dec-tile_size/2],
+        [tile_center_ra-tile_size/2, tile_center_dec+tile_size/2],
+        [tile_center_ra+tile_size/2, tile_center_dec+tile_size/2],
+        [tile_center_ra+tile_size/2, tile_center_dec-tile_size/2]]
+    tile_bounds_vec = hp.pixelfunc.ang2vec(
+        np.array(tile_bounds_radec)[:, 0], np.array(tile_bounds_radec)[:, 1],
+        lonlat=True)
+    # query_polygon returns sorted pixel numbers, so each map pixel can be
+    # looked up with a binary search
+    use_pixels = hp.query_polygon(
+        healpix_map.nside, tile_bounds_vec, nest=healpix_map.nest)
+    use = np.zeros(len(healpix_map), dtype=bool)
+    if len(use_pixels) > 0:
+        inds = np.searchsorted(use_pixels, healpix_map.pixelnums)
+        inds[inds == len(use_pixels)] = 0
+        use = use_pixels[inds] == healpix_map.pixelnums
+    return healpix_map.select(use)
+
+
+def load_map(data_filename, memmap=True):
+
+    # Read a partial-sky HEALPix map. The PIXEL and SIGNAL columns are
+    # returned as arrays that, with memmap=True, are views into the
+    # memory-mapped FITS file rather than copies.
+    contents = fits.open(data_filename, memmap=memmap)
+    try:
+        nside = int(contents[1].header['nside'])
+        ordering = contents[1].header['ordering']
+        data = contents[1].data
+        pixel_vals = data.field('PIXEL')
+        signal_vals = data.field('SIGNAL')
+    finally:
+        contents.close()
 
     if ordering.lower() == 'ring':
         nest = False
     elif ordering.lower() == 'nested':
         nest = True
     else:
-        print 'ERROR: Invalid ordering parameter.'
-        print 'Ordering must be "ring" or "nested". Exiting.'
-        sys.exit(1)
-
+        raise ValueError(
+            'Invalid ordering parameter "{}" in {}. Ordering must be "ring" '
+            'or "nested".'.format(ordering, data_filename))
 
     if len(pixel_vals) != len(signal_vals):
-        print 'ERROR: Pixel index and data lengths do not match. Exiting.'
-        sys.exit(1)
-
-    pixel_data = []
-    for i in range(len(pixel_vals)):
-        data_point = HealpixPixel(pixel_vals[i], signal_vals[i])
-        pixel_data.append(data_point)
-
-    return pixel_data, nside, nest
+        raise ValueError(
+            'Pixel index and data lengths do not match in {}.'.format(
+                data_filename))
+
+    return HealpixMap(pixel_vals, signal_vals, nside, nest)
+
+
+class HealpixMap:
+
+    # Partial-sky HEALPix map stored as parallel arrays of pixel numbers and
+    # signal values
+
+    def __init__(self, pixelnums, signal, nside, nest):
+        self.pixelnums = pixelnums
+        self.signal = signal
+        self.nside = nside
+        self.nest = nest
+
+    def __len__(self):
+        return len(self.pixelnums)
+
+    def select(self, use):
+        # Copy of the map restricted to the pixels where use is True
+        return HealpixMap(np.array(self.pixelnums[use]),
+                          np.array(self.signal[use]), self.nside, self.nest)
+
+    @property
+    def ordering(self):
+        if self.nest:
+            return 'nested'
+        return 'ring'
+
+
+class HealpixMosaic:
+
+    # Sparse weighted sum of HEALPix maps. Only pixels that have been covered
+    # are stored, as sorted pixel numbers with the matching sums of
+    # weight*signal and of weights. Added maps are buffered and merged in
+    # once buffer_size pixels are waiting, so each merge is a single sort.
+
+    def __init__(self, buffer_size=10000000):
+        self.nside = None
+        self.nest = None
+        self.buffer_size = buffer_size
+        self.pixelnums = np.zeros(0, dtype=np.int64)
+        self.weighted_signal = np.zeros(0)
+        self.weights = np.zeros(0)
+        self.n_obs = np.zeros(0, dtype=np.int32)
+        self.pending = []
+        self.n_pending = 0
+
+    def add(self, healpix_map, weight=1.):
+        # weight is a single value for the whole map or one per pixel
+        if self.nside is None:
+            self.nside = healpix_map.nside
+            self.nest = healpix_map.nest
+        elif (healpix_map.nside, healpix_map.nest) != (self.nside, self.nest):
+            raise ValueError(
+                'All maps must have the same nside and ordering.')
+
+        signal = np.asarray(healpix_map.signal, dtype=float)
+        weights = np.zeros(len(signal)) + weight
+        use = np.isfinite(signal) & (weights > 0)
+        self.pending.append((
+            np.asarray(healpix_map.pixelnums, dtype=np.int64)[use],
+            weights[use]*signal[use], weights[use]))
+        self.n_pending += np.count_nonzero(use)
+        if self.n_pending >= self.buffer_size:
+            self.flush()
+
+    def flush(self):
+        if len(self.pending) == 0:
+            return
+        pixelnums, inverse = np.unique(
+            np.concatenate(
+                [self.pixelnums] + [pending[0] for pending in self.pending]),
+            return_inverse=True)
+        self.weighted_signal = np.bincount(
+            inverse, minlength=len(pixelnums), weights=np.concatenate(
+                [self.weighted_signal]
+                + [pending[1] for pending in self.pending]))
+        self.weights = np.bincount(
+            inverse, minlength=len(pixelnums), weights=np.concatenate(
+                [self.weights] + [pending[2] for pending in self.pending]))
+        self.n_obs = np.bincount(
+            inverse, minlength=len(pixelnums), weights=np.concatenate(
+                [self.n_obs]
+                + [np.ones(len(pending[0])) for pending in self.pending])
+            ).astype(np.int32)
+        self.pixelnums = pixelnums
+        self.pending = []
+        self.n_pending = 0
+
+    def __len__(self):
+        self.flush()
+        return len(self.pixelnums)
+
+    def get_map(self):
+        # Weighted average of the added maps
+        self.flush()
+        return HealpixMap(self.pixelnums, self.weighted_signal/self.weights,
+                          self.nside, self.nest)
+
+    def write(self, data_filename):
+        # Save as a partial-sky (explicitly indexed) HEALPix FITS file that
+        # load_map can read back
+        healpix_map = self.get_map()
+        columns = fits.ColDefs([
+            fits.Column(name='PIXEL', format='K',
+                        array=healpix_map.pixelnums),
+            fits.Column(name='SIGNAL', format='E', array=healpix_map.signal),
+            fits.Column(name='WEIGHT', format='E', array=self.weights),
+            fits.Column(name='N_OBS', format='J', array=self.n_obs)])
+        table = fits.BinTableHDU.from_columns(columns)
+        table.header['PIXTYPE'] = 'HEALPIX'
+        table.header['ORDERING'] = healpix_map.ordering.upper()
+        table.header['NSIDE'] = self.nside
+        table.header['INDXSCHM'] = 'EXPLICIT'
+        table.header['OBJECT'] = 'PARTIAL'
+        fits.HDUList([fits.PrimaryHDU(), table]).writeto(
+            data_filename, overwrite=True)
 
 
 class HealpixPixel:
@@ -192,16 +464,10 @@ class HealpixPixel:
         self.dec = dec
 
     def get_pixel_corners(self, nside, nest):
-        coords = hp.boundaries(nside, self.pixelnum, step=1,
-                               nest=nest)
-        ras, decs = hp.pixelfunc.vec2ang(np.transpose(coords), lonlat=True)
-        for i, ra in enumerate(ras):
-            if ra > 270:
-                ras[i] -= 360.
-        self.pix_corner_ras = ras
-        self.pix_corner_decs = decs
+        ras, decs = get_pixel_corners(self.pixelnum, nside, nest)
+        self.pix_corner_ras = ras[0]
+        self.pix_corner_decs = decs[0]
 
 
 if __name__ == '__main__':
-    download_data()
     plot_healpix_tiling()
@@ -1,5 +1,5 @@
 #!/home/ubuntu/miniconda2/bin/python
-import sys, os, math, optparse
+import sys, os, math, optparse, heapq
 o = optparse.OptionParser()
 o.add_option('-w', '--wrap', dest='wrap', action='store_true',
     help='Instead of pulling nothing for indices off the end of the list, wrap around and repull arguments from the beginning.')
@@ -9,8 +9,54 @@ o.add_option('--taskid',type=int,default=1,
     help='current taskid. Use in conjunction with -t for non-gridengine list splitting mode.')
 o.add_option('-f',action='store_true',
     help='look in the input files for args instead [default = false]')
+o.add_option('--weights', type='str',
+    help='File of "arg weight" lines giving the expected cost of each arg (e.g. uvfits size). Tasks are then given sets of args with balanced total weight instead of equal counts.')
+o.add_option('--history', type='str',
+    help='File of "arg runtime" lines from past runs. Like --weights, using the mean runtime of each arg. Args without a history get the median weight.')
 opts,args = o.parse_args(sys.argv[1:])
 
+def read_weights(filename):
+    # Mean of the values given for each arg in a file of "arg value" lines
+    totals = {}
+    counts = {}
+    for line in open(filename).readlines():
+        fields = line.split()
+        if len(fields) < 2:
+            continue
+        totals[fields[0]] = totals.get(fields[0], 0.) + float(fields[1])
+        counts[fields[0]] = counts.get(fields[0], 0) + 1
+    return dict([(arg, totals[arg] / counts[arg]) for arg in totals])
+
+def balanced_split(args, weights, ntasks):
+    # Longest-processing-time-first scheduling: take args from heaviest to
+    # lightest and give each to the task with the least total weight so far.
+    # Ties are broken by arg and by task number, so every task computes the
+    # same split independently. Each task's args keep their input order.
+    known = sorted([weights[arg.strip()] for arg in args if arg.strip() in weights])
+    if len(known) > 0:
+        default = known[len(known) // 2]
+    else:
+        default = 1.
+    arg_weights = [weights.get(arg.strip(), default) for arg in args]
+    order = sorted(range(len(args)), key=lambda k: (-arg_weights[k], args[k].strip(), k))
+    loads = [(0., task) for task in range(ntasks)]
+    assignment = [[] for task in range(ntasks)]
+    for k in order:
+        load, task = heapq.heappop(loads)
+        assignment[task].append(k)
+        heapq.heappush(loads, (load + arg_weights[k], task))
+    return [[args[k] for k in sorted(task_args)] for task_args in assignment]
+
+def split_args(n, m, i):
+    if (m-n) <= len(args) or not opts.wrap:
+        if weights is not None:
+            print ' '.join(balanced_split(args, weights, m - n + 1)[i])
+        else:
+            num = int(math.ceil(float(len(args)) / (m - n + 1)))
+            print ' '.join(args[num*i:num*(i+1)])
+    else:
+        print args[i % len(args)]
+
 if opts.f:
     fileargs = []
     for file in args:
@@ -18,23 +64,20 @@ if opts.f:
         for line in lines:
             fileargs.append(line)
     args  = fileargs
+weights = None
+if opts.weights is not None:
+    weights = read_weights(opts.weights)
+elif opts.history is not None:
+    weights = read_weights(opts.history)
 if not opts.t is None:
     n = int(opts.t.split(':')[0])
     m = int(opts.t.split(':')[1])
     i = opts.taskid-1
-    if (m-n) <= len(args) or not opts.wrap:
-        num = int(math.ceil(float(len(args)) / (m - n + 1)))
-        print ' '.join(args[num*i:num*(i+1)])
-    else:
-        print args[i % len(args)]
+    split_args(n, m, i)
     sys.exit(0)
 try:
     n = int(os.environ['SGE_TASK_FIRST'])
     m = int(os.environ['SGE_TASK_LAST'])
     i = int(os.environ['SGE_TASK_ID']) - 1
-    if (m-n) <= len(args) or not opts.wrap:
-        num = int(math.ceil(float(len(args)) / (m - n + 1)))
-        print ' '.join(args[num*i:num*(i+1)])
-    else:
-        print args[i % len(args)]
+    split_args(n, m, i)
 except(KeyError,ValueError): print ' '.join(args)
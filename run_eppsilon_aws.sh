@@ -116,15 +116,6 @@ PSpath='~/MWA/eppsilon/'
 #Versions made during integrate list logic check above
 echo Version is $version
 
-if [ ! -e "$integrate_list" ]
-then
-    first_line=$integrate_list
-else
-    first_line=$(head -n 1 $integrate_list)
-fi
-
-first_line_len=$(echo ${#first_line})
-
 #create Healpix download location with full permissions
 if [ -d /Healpix ]; then
     sudo chmod -R 777 /Healpix
@@ -133,109 +124,55 @@ else
     sudo mkdir -m 777 /Healpix
 fi
 
-if [ "$first_line_len" == 10 ]; then
-    
-    obs=0   
-
-    while read line
-    do
-        ((chunk=obs/20+1))		#integer division results in chunks labeled 0 (first 100), 1 (second 100), etc
-        echo $line >> /Healpix/${version}_int_chunk${chunk}.txt	#put that obs id into the right txt file
-        ((obs++))			#increment obs for the next run through
-    done < $integrate_list
-    nchunk=$chunk 			#number of chunks we ended up with
-
-else
-
-    if [[ "$first_line" != */* ]]; then
-   
-        chunk=0 
-        while read line
-        do
-            echo $line >> /Healpix/${version}_int_chunk${chunk}.txt        #put that obs id into the right txt file
-        done < $integrate_list
-        nchunk=$chunk                       #number of chunks we ended up with
-    
-    else
-
-        chunk=0 
-        while read line
-        do
-            echo $line >> /Healpix/${version}_int_chunk${chunk}.txt        #put that obs id into the right txt file
-        done < $integrate_list
-        nchunk=$chunk                       #number of chunks we ended up with
-
-    fi
-
-fi
-
 outfile=~/grid_out
 errfile=~/grid_out
 
 unset idlist
-if [ "$ps_only" -ne "1" ]; then   
-    if [ "$nchunk" -gt "1" ]; then
-
-        # set up files for master integration
-        sub_cubes_list=/Healpix/${version}_sub_cubes.txt
-        rm $sub_cubes_list # remove any old lists
-
-        # launch separate chunks
-        for chunk in $(seq 1 $nchunk); do
-	    chunk_obs_list=/Healpix/${version}_int_chunk${chunk}.txt
-            readarray chunk_obs_array < $chunk_obs_list
-	    chunk_obs_array=$( IFS=$':'; echo "${chunk_obs_array[*]}" ) #qsub can't take arrays
-	    
-            for evenodd in even odd; do
-		for pol in XX YY; do 
-	    	    message=$(qsub ${hold_str} -V -b y -v file_path_cubes=$FHDdir,obs_list_array="$chunk_obs_array",obs_list_path=$chunk_obs_list,version=$version,chunk=$chunk,nslots=$nslots,legacy=$legacy,evenodd=$evenodd,pol=$pol -e $errfile -o $outfile -N int_c_${version} -pe smp $nslots -sync y integration_job_aws.sh)
-	    	    message=($message)
-		done
-	    done
-	    echo Combined_obs_${version}_int_chunk${chunk} >> $sub_cubes_list # trick it into finding our sub cubes
-        done
+if [ "$ps_only" -ne "1" ]; then
+
+    # Plan the integration as a tree of subcube integrations, reusing any
+    # subcubes already in ${FHDdir}/Healpix/ from earlier integrations.
+    # Inputs whose cubes don't exist yet (e.g. with -h on a running
+    # firstpass) are planned too; the leaf integrations wait on the hold.
+    plan_file=/Healpix/${version}_int_plan.txt
+    integration_planner.py -d $FHDdir -f $integrate_list -v $version \
+    --job_slots ${int_job_slots:-8} > $plan_file
+    if [[ $? -ne 0 ]]; then
+        echo "Integration planning failed"
+        exit 1
+    fi
 
-        idlist_int_chunks=(`qstat | grep "int_c_" | cut -b -7`)
-	idlist_int_chunks=$( IFS=$','; echo "${idlist_int_chunks[*]}" )
-	hold_str="-hold_jid ${idlist_int_chunks}"
+    # Submit an integration per even/odd and pol for each node of the tree,
+    # holding each node on the jobs of the nodes it integrates
+    unset node_ids
+    declare -A node_ids
+    while read chunk int_name chunk_obs_list chunk_obs_array node_holds \
+     chunk_members; do
+        if [ "$node_holds" == "-" ]; then
+            node_hold_str=${hold_str}
+        else
+            node_hold_ids=""
+            for node in ${node_holds//,/ }; do
+                node_hold_ids=${node_hold_ids},${node_ids[$node]}
+            done
+            node_hold_str="-hold_jid ${node_hold_ids#,}"
+        fi
 
-        # master integrator
-        chunk=0
-        readarray chunk_obs_array < $sub_cubes_list
-	chunk_obs_array=$( IFS=$':'; echo "${chunk_obs_array[*]}" ) #qsub can't take arrays
-	
-        for evenodd in even odd; do
-	    for pol in XX YY; do 
-	    	message=$(qsub ${hold_str} -V -b y -v file_path_cubes=$FHDdir,obs_list_array="$chunk_obs_array",obs_list_path=$sub_cubes_list,version=$version,chunk=$chunk,nslots=$nslots,legacy=$legacy,evenodd=$evenodd,pol=$pol -e $errfile -o $outfile -N int_m_${version} -pe smp $nslots -sync y integration_job_aws.sh)
-        	message=($message)
-	    done
-	done
-
-        idlist_int_master=(`qstat | grep "int_m_" | cut -b -7`)
-	idlist_int_master=$( IFS=$','; echo "${idlist_int_master[*]}" )
-	hold_str="-hold_jid ${idlist_int_master}"
-
-
-    else
-
-        # Just one integrator
-        mv /Healpix/${version}_int_chunk1.txt /Healpix/${version}_int_chunk0.txt
-        chunk=0
-        chunk_obs_list=/Healpix/${version}_int_chunk${chunk}.txt
-        readarray chunk_obs_array < $chunk_obs_list
-	chunk_obs_array=$( IFS=$':'; echo "${chunk_obs_array[*]}" ) #qsub can't take arrays
-	
         for evenodd in even odd; do
-	    for pol in XX YY; do
-        	message=$(qsub ${hold_str} -V -b y -v file_path_cubes=$FHDdir,obs_list_array="$chunk_obs_array",obs_list_path=$chunk_obs_list,version=$version,chunk=$chunk,nslots=$nslots,legacy=$legacy,evenodd=$evenodd,pol=$pol -e $errfile -o $outfile -N int_${version} -pe smp $nslots -sync y integration_job_aws.sh)
-       		message=($message)
-	    done
-	done
-
-        idlist_int=(`qstat | grep "int_" | cut -b -7`)
-        hold_str="-hold_jid ${idlist_int}"
+            for pol in XX YY; do
+                job_id=$(qsub -terse ${node_hold_str} -V -b y -v file_path_cubes=$FHDdir,obs_list_array="$chunk_obs_array",members_array="$chunk_members",obs_list_path=$chunk_obs_list,version=$version,chunk=$chunk,int_name=$int_name,nslots=$nslots,legacy=$legacy,evenodd=$evenodd,pol=$pol -e $errfile -o $outfile -N int_${version} -pe smp $nslots integration_job_aws.sh)
+                node_ids[$chunk]=${node_ids[$chunk]},${job_id}
+            done
+        done
+        node_ids[$chunk]=${node_ids[$chunk]#,}
+        root_chunk=$chunk
+    done < $plan_file
 
+    # The power spectrum jobs wait for the root integration
+    if [ ! -z ${root_chunk} ]; then
+        hold_str="-hold_jid ${node_ids[$root_chunk]}"
     fi
+
 else
     echo "Running only ps code" # Just PS if flag has been set
 fi
@@ -0,0 +1,253 @@
+#!/usr/bin/env python
+
+# Node-local cache for the uvfits and metafits that fhd_job_aws.sh stages in
+# /uvfits. Files stay on the node after a job so re-runs of the same obsids
+# (and other slots running them) don't download them again, and the least
+# recently used unpinned files are evicted to keep the cache under a size
+# limit. Jobs running at the same time that need the same file share one
+# download: each file has a lock that is held while it is downloaded, and
+# a file is only used once its size matches the object in the bucket (and,
+# with --hash, its md5 matches the one recorded when it was downloaded).
+#
+# Usage: staging_cache.py fetch url [--pin name] [--cache_dir /uvfits]
+#        staging_cache.py release url --pin name
+#        staging_cache.py evict
+#
+# fetch prints the local filename. A pinned file isn't evicted until it is
+# released or the pin is older than --max_pin_age. Exits with 2 if the
+# object doesn't exist and 1 if it couldn't be downloaded.
+
+import os
+import sys
+import json
+import time
+import fcntl
+import hashlib
+import optparse
+import object_store
+
+
+def get_md5(filename, block_size=2**24):
+
+    md5 = hashlib.md5()
+    data_file = open(filename, 'rb')
+    try:
+        block = data_file.read(block_size)
+        while block:
+            md5.update(block)
+            block = data_file.read(block_size)
+    finally:
+        data_file.close()
+    return md5.hexdigest()
+
+
+class FileLock:
+
+    # Exclusive flock on a lock file, shared between processes on the node
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.lock_file = None
+
+    def acquire(self, blocking=True):
+        self.lock_file = open(self.filename, 'a')
+        try:
+            fcntl.flock(self.lock_file.fileno(), fcntl.LOCK_EX | (
+                0 if blocking else fcntl.LOCK_NB))
+        except IOError:
+            self.lock_file.close()
+            self.lock_file = None
+            return False
+        return True
+
+    def release(self):
+        fcntl.flock(self.lock_file.fileno(), fcntl.LOCK_UN)
+        self.lock_file.close()
+        self.lock_file = None
+
+
+class StagingCache:
+
+    # Cached files are stored in cache_dir under the object's file name, so
+    # jobs find them where they were downloaded to before. Locks, pins and
+    # the record of each cached object are kept in cache_dir/.staging.
+
+    def __init__(self, cache_dir='/uvfits', max_size=100e9,
+                 max_pin_age=2*86400., verify_hash=False):
+        self.cache_dir = cache_dir
+        self.max_size = max_size
+        self.max_pin_age = max_pin_age
+        self.verify_hash = verify_hash
+        self.state_dir = os.path.join(cache_dir, '.staging')
+        if not os.path.isdir(self.state_dir):
+            try:
+                os.makedirs(self.state_dir)
+            except OSError:
+                if not os.path.isdir(self.state_dir):
+                    raise
+
+    def get_paths(self, name):
+        # Cached file, its lock file, its entry (JSON record of the object it
+        # holds) and its pin directory
+        state = os.path.join(self.state_dir, name)
+        return (os.path.join(self.cache_dir, name), '{}.lock'.format(state),
+                '{}.entry'.format(state), '{}.pins'.format(state))
+
+    def read_entry(self, entry_filename):
+        try:
+            return json.load(open(entry_filename))
+        except (IOError, ValueError):
+            return None
+
+    def write_entry(self, entry_filename, entry):
+        temp_filename = '{}.tmp'.format(entry_filename)
+        entry_file = open(temp_filename, 'w')
+        json.dump(entry, entry_file)
+        entry_file.close()
+        os.rename(temp_filename, entry_filename)
+
+    def is_valid(self, filename, entry, size):
+        if entry is None or entry['size'] != size or \
+                not os.path.isfile(filename) or \
+                os.path.getsize(filename) != size:
+            return False
+        if self.verify_hash:
+            return entry.get('md5') == get_md5(filename)
+        return True
+
+    def fetch(self, url, pin=None):
+        # Local filename of the object at url, downloading it if the cache
+        # doesn't have a valid copy. Returns None if the object doesn't exist.
+        store, key = object_store.split_url(url)
+        info = store.stat(key)
+        if info is None:
+            return None
+        name = os.path.basename(key)
+        filename, lock_filename, entry_filename, pin_dir = \
+            self.get_paths(name)
+
+        lock = FileLock(lock_filename)
+        lock.acquire()
+        try:
+            entry = self.read_entry(entry_filename)
+            if entry is None or entry['url'] != url or \
+                    not self.is_valid(filename, entry, info.size):
+                # A file without an entry (e.g. staged before the cache was
+                # used) is kept if its size matches
+                if entry is not None and os.path.isfile(filename):
+                    os.remove(filename)
+                self.evict(info.size)
+                object_store.fetch(store, key, filename)
+                entry = {'url': url, 'size': info.size}
+                if self.verify_hash:
+                    entry['md5'] = get_md5(filename)
+                self.write_entry(entry_filename, entry)
+            os.utime(filename, None)  # mark as recently used for eviction
+            if pin is not None:
+                if not os.path.isdir(pin_dir):
+                    os.makedirs(pin_dir)
+                open(os.path.join(pin_dir, pin), 'w').close()
+        finally:
+            lock.release()
+        return filename
+
+    def release(self, url, pin):
+        pin_filename = os.path.join(
+            self.get_paths(os.path.basename(url))[3], pin)
+        if os.path.isfile(pin_filename):
+            os.remove(pin_filename)
+
+    def is_pinned(self, pin_dir):
+        if not os.path.isdir(pin_dir):
+            return False
+        pinned = False
+        for pin in os.listdir(pin_dir):
+            pin_filename = os.path.join(pin_dir, pin)
+            if time.time() - os.path.getmtime(pin_filename) > \
+                    self.max_pin_age:
+                os.remove(pin_filename)  # left by a job that died
+            else:
+                pinned = True
+        return pinned
+
+    def evict(self, needed=0):
+        # Remove least recently used, unpinned files until needed more bytes
+        # fit under max_size. Files locked by another job (being fetched or
+        # pinned right now) are skipped.
+        evict_lock = FileLock(os.path.join(self.state_dir, 'evict.lock'))
+        evict_lock.acquire()
+        try:
+            cached = []
+            for entry_name in os.listdir(self.state_dir):
+                if not entry_name.endswith('.entry'):
+                    continue
+                filename, lock_filename, entry_filename, pin_dir = \
+                    self.get_paths(entry_name[:-len('.entry')])
+                if os.path.isfile(filename):
+                    file_stat = os.stat(filename)
+                    cached.append((file_stat.st_mtime, file_stat.st_size,
+                                   filename, lock_filename, entry_filename,
+                                   pin_dir))
+            total_size = sum([cache_file[1] for cache_file in cached])
+            for mtime, size, filename, lock_filename, entry_filename, \
+                    pin_dir in sorted(cached):
+                if total_size + needed <= self.max_size:
+                    break
+                lock = FileLock(lock_filename)
+                if not lock.acquire(blocking=False):
+                    continue
+                try:
+                    if not self.is_pinned(pin_dir):
+                        os.remove(entry_filename)
+                        os.remove(filename)
+                        total_size -= size
+                finally:
+                    lock.release()
+            if total_size + needed > self.max_size:
+                sys.stderr.write(
+                    'WARNING: staging cache {} is over its {:.0f} B limit, '
+                    'all remaining files are in use.\n'.format(
+                        self.cache_dir, self.max_size))
+        finally:
+            evict_lock.release()
+
+
+if __name__ == '__main__':
+    o = optparse.OptionParser(
+        usage='%prog fetch|release url [options]\n       %prog evict')
+    o.add_option('--cache_dir', type='str', default='/uvfits',
+                 help='Cache directory [default %default].')
+    o.add_option('--max_size', type='float', default=100e9,
+                 help='Cache size limit in bytes [default %default].')
+    o.add_option('--max_pin_age', type='float', default=2*86400.,
+                 help='Seconds after which pins count as stale '
+                      '[default %default].')
+    o.add_option('--pin', type='str',
+                 help='Name to pin the file with until it is released, '
+                      'e.g. the job ID.')
+    o.add_option('--hash', action='store_true',
+                 help='Check cached files against their md5 as well as '
+                      'their size.')
+    opts, args = o.parse_args(sys.argv[1:])
+    if len(args) == 0 or args[0] not in ['fetch', 'release', 'evict'] or \
+            (args[0] != 'evict' and len(args) != 2):
+        o.error('Expected fetch url, release url or evict.')
+    if args[0] == 'release' and opts.pin is None:
+        o.error('release needs --pin.')
+
+    cache = StagingCache(opts.cache_dir, opts.max_size, opts.max_pin_age,
+                         opts.hash)
+    if args[0] == 'fetch':
+        try:
+            filename = cache.fetch(args[1], opts.pin)
+        except Exception as error:
+            sys.stderr.write('ERROR: {}\n'.format(error))
+            sys.exit(1)
+        if filename is None:
+            sys.stderr.write('ERROR: {} not found.\n'.format(args[1]))
+            sys.exit(2)
+        print(filename)
+    elif args[0] == 'release':
+        cache.release(args[1], opts.pin)
+    else:
+        cache.evict()
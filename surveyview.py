@@ -2,6 +2,12 @@
 
 # Tools for characterizing a survey
 
+import numpy as np
+
+observation_dtype = np.dtype([
+    ('obsid', np.int64), ('lst', float), ('ra', float), ('dec', float),
+    ('az', float), ('el', float)])
+
 
 class Observation:
 
@@ -24,18 +30,18 @@ class KnownSource:
 
 def load_survey(obs_info_file):
 
+    # Read an obs info file into a structured array with one row per unique
+    # line, in the same sorted order as the lines
     obsfile = open(obs_info_file, "r")
-    obsinfo = [line.split("\n") for line in obsfile.readlines()]
+    obsinfo = obsfile.read().split("\n")[1:]  # remove header
     obsfile.close()
-    obsinfo = [obs[0] for obs in obsinfo]
-    obsinfo = obsinfo[1:]  # remove header
-    obsinfo = list(set(obsinfo))
-    obsinfo.sort()
+    obsinfo = np.unique([line for line in obsinfo if line != ""])
 
-    observations = []
-    for info in obsinfo:
-        info = info.split(", ")
-        observations.append(Observation(info))
+    observations = np.zeros(len(obsinfo), dtype=observation_dtype)
+    if len(obsinfo) > 0:
+        columns = np.array([line.split(", ")[:6] for line in obsinfo]).T
+        for i, field in enumerate(observations.dtype.names):
+            observations[field] = columns[i]
 
     return observations
 
@@ -45,48 +51,80 @@ def get_pointings(observations):
     # Note that this code likely doesn't work for surveys other than the
     # diffuse survey.
 
-    # Round the declinations to the nearest 6th to clump them in bands
-    decs_round = [int(obs.dec/6.)*6 for obs in observations]
-    decs_set = list(set(decs_round))
-    decs_set.sort()
-
-    Azimuths = [round(obs.az) for obs in observations]
-    Elevations = [round(obs.el) for obs in observations]
-
-    dec_pointings_options = [3, 2, 1, 0, -1, -2, -3]
-    azimuth_pointings_options = [2, 1, 0, -1, -2]
-    for band_index, dec_band in enumerate(decs_set):
-        Azimuths_band = []
-        Elevations_band = []
-        for obs_index in range(len(observations)):
-            if decs_round[obs_index] == dec_band:
-                Azimuths_band.append(Azimuths[obs_index])
-                Elevations_band.append(Elevations[obs_index])
-        AzEls_band = zip(Azimuths_band, Elevations_band)
-        AzEls_band_set = list(set(AzEls_band))
-        Azimuth_band_set = [value[0] for value in AzEls_band_set]
-        Elevations_band_set = [value[1] for value in AzEls_band_set]
-        Az_zero = Azimuth_band_set[
-            Elevations_band_set.index(max(Elevations_band_set))]
-        Azimuth_band_set_sort = list(sorted(Azimuth_band_set))
-        Az_wrap = 0
-        for Az in Azimuth_band_set_sort:
-            if Az > Az_zero + 180:
-                Az_wrap += 1
-        if Az_wrap > 0:
-            Azimuth_band_set_sort = (Azimuth_band_set_sort[
-                len(Azimuth_band_set_sort)-Az_wrap:]
-                + Azimuth_band_set_sort[:len(Azimuth_band_set_sort)-Az_wrap])
-
-        for obs_index in range(len(observations)):
-            if decs_round[obs_index] == dec_band:
-                observations[obs_index].pointing = '({}, {})'.format(
-                    azimuth_pointings_options[
-                        Azimuth_band_set_sort.index(Azimuths[obs_index])],
-                    dec_pointings_options[band_index]
-                    )
+    # Returns a copy of the observations with their (az, dec) pointing
+    # labels added. Observations are clumped into dec bands, and within each
+    # band the distinct (az, el) pairs are ordered by azimuth, starting from
+    # the highest elevation pair and wrapping past 180 degrees from it.
 
-    return observations
+    dec_pointings_options = np.array([3, 2, 1, 0, -1, -2, -3])
+    azimuth_pointings_options = np.array([2, 1, 0, -1, -2])
+
+    # Round the declinations to the nearest 6th to clump them in bands
+    decs_round = np.trunc(observations['dec']/6.).astype(int)*6
+    decs_set, band_inds = np.unique(decs_round, return_inverse=True)
+    nbands = len(decs_set)
+
+    azimuths = round_half_away(observations['az'])
+    elevations = round_half_away(observations['el'])
+
+    # Distinct (band, az, el) combinations, sorted by band then azimuth
+    pair_keys = np.unique(
+        np.column_stack((band_inds, azimuths, elevations)).view(
+            np.dtype([('band', float), ('az', float), ('el', float)])))
+    pair_bands = pair_keys['band'].astype(int)
+    pair_azimuths = pair_keys['az']
+    pair_elevations = pair_keys['el']
+    band_starts = np.searchsorted(pair_bands, np.arange(nbands))
+    band_sizes = np.bincount(pair_bands, minlength=nbands)
+
+    # Azimuth of the highest elevation pair in each band
+    max_elevations = np.maximum.reduceat(pair_elevations, band_starts)
+    highest = np.flatnonzero(
+        pair_elevations == max_elevations[pair_bands])
+    highest = highest[np.unique(pair_bands[highest], return_index=True)[1]]
+    az_zero = pair_azimuths[highest]
+
+    # Pairs more than 180 degrees past az_zero wrap around to the front
+    az_wrap = np.bincount(
+        pair_bands, weights=pair_azimuths > az_zero[pair_bands] + 180,
+        minlength=nbands).astype(int)
+
+    # Position of each observation's azimuth in its band's sorted list
+    az_positions = np.searchsorted(
+        pair_bands*1000. + pair_azimuths, band_inds*1000. + azimuths
+        ) - band_starts[band_inds]
+    n_unwrapped = (band_sizes - az_wrap)[band_inds]
+    az_positions = np.where(
+        az_positions >= n_unwrapped, az_positions - n_unwrapped,
+        az_positions + az_wrap[band_inds])
+
+    pointing_azs = azimuth_pointings_options[az_positions]
+    pointing_decs = dec_pointings_options[band_inds]
+    pointings, pointing_inds = np.unique(
+        np.column_stack((pointing_azs, pointing_decs)).view(
+            np.dtype([('az', int), ('dec', int)])).ravel(),
+        return_inverse=True)
+    pointing_labels = np.array([
+        '({}, {})'.format(pointing['az'], pointing['dec'])
+        for pointing in pointings])
+
+    observations_pointings = np.zeros(len(observations), dtype=(
+        observations.dtype.descr
+        + [('pointing_az', int), ('pointing_dec', int), ('pointing', 'S8')]))
+    for field in observations.dtype.names:
+        observations_pointings[field] = observations[field]
+    observations_pointings['pointing_az'] = pointing_azs
+    observations_pointings['pointing_dec'] = pointing_decs
+    observations_pointings['pointing'] = pointing_labels[pointing_inds]
+
+    return observations_pointings
+
+
+def round_half_away(values):
+
+    # Round to the nearest integer with halves rounded away from zero, like
+    # Python 2's round (np.round rounds halves to even)
+    return np.sign(values)*np.floor(np.abs(values) + 0.5)
 
 
 def get_a_team_sources():
@@ -113,3 +151,105 @@ def get_a_team_sources():
                                    a_team_decs[i]))
 
     return a_teams
+
+
+class SkyIndex:
+
+    # KD-tree over the unit vectors of a set of RA/Dec positions (in
+    # degrees) for bulk cone searches and nearest-neighbour lookups. Angular
+    # radii are converted to chord lengths, which order the same way.
+
+    def __init__(self, ras, decs):
+        # Imported here so that the rest of the module, which
+        # plot_healpix_aws imports on the nodes, doesn't need scipy
+        from scipy.spatial import cKDTree
+        self.ras = np.atleast_1d(np.asarray(ras, dtype=float))
+        self.decs = np.atleast_1d(np.asarray(decs, dtype=float))
+        self.tree = cKDTree(radec_to_vec(self.ras, self.decs))
+
+    def __len__(self):
+        return len(self.ras)
+
+    def cone_search(self, ras, decs, radius):
+        # For each query position, the indices of the indexed positions
+        # within radius degrees of it
+        matches = self.tree.query_ball_point(
+            radec_to_vec(ras, decs), angle_to_chord(radius))
+        return [np.array(sorted(match), dtype=int)
+                for match in np.atleast_1d(matches)]
+
+    def nearest(self, ras, decs, k=1, max_separation=None):
+        # Indices of and separations (degrees) to the k nearest indexed
+        # positions for each query position. Where there are fewer than k
+        # within max_separation degrees, the index is len(self) and the
+        # separation is inf.
+        if max_separation is None:
+            max_chord = np.inf
+        else:
+            max_chord = angle_to_chord(max_separation)
+        chords, inds = self.tree.query(
+            radec_to_vec(ras, decs), k=k, distance_upper_bound=max_chord)
+        return inds, chord_to_angle(chords)
+
+
+def radec_to_vec(ras, decs):
+
+    ras = np.radians(np.atleast_1d(ras))
+    decs = np.radians(np.atleast_1d(decs))
+    return np.column_stack((
+        np.cos(decs)*np.cos(ras), np.cos(decs)*np.sin(ras), np.sin(decs)))
+
+
+def angle_to_chord(angle):
+
+    return 2.*np.sin(np.radians(np.minimum(angle, 180.))/2.)
+
+
+def chord_to_angle(chord):
+
+    with np.errstate(invalid='ignore'):
+        return np.where(
+            np.isfinite(chord),
+            np.degrees(2.*np.arcsin(np.clip(chord/2., 0, 1))), np.inf)
+
+
+def get_source_proximity(observations, sources, radius=None):
+
+    # Nearest known source to each observation's pointing and its
+    # separation in degrees. Observations with no source within radius
+    # degrees get a name of '' and a separation of inf.
+    source_index = SkyIndex([source.ra for source in sources],
+                            [source.dec for source in sources])
+    inds, separations = source_index.nearest(
+        observations['ra'], observations['dec'], max_separation=radius)
+    names = np.array([source.name for source in sources] + [''])
+    return names[inds], separations
+
+
+def get_observations_near(observations, ra, dec, radius):
+
+    # Observations pointed within radius degrees of (ra, dec)
+    obs_index = SkyIndex(observations['ra'], observations['dec'])
+    return observations[obs_index.cone_search(ra, dec, radius)[0]]
+
+
+def assign_tiles(observations, tile_center_ras, tile_center_decs,
+                 max_separation=None):
+
+    # Obsid of the observation pointed closest to each tile center, or -1
+    # where no observation is within max_separation degrees
+    obs_index = SkyIndex(observations['ra'], observations['dec'])
+    inds, separations = obs_index.nearest(
+        tile_center_ras, tile_center_decs, max_separation=max_separation)
+    obsids = np.append(observations['obsid'], -1)
+    return obsids[inds]
+
+
+def get_tile_coverage(observations, tile_center_ras, tile_center_decs,
+                      radius):
+
+    # Obsids of every observation pointed within radius degrees of each
+    # tile center
+    obs_index = SkyIndex(observations['ra'], observations['dec'])
+    return [observations['obsid'][inds] for inds in obs_index.cone_search(
+        tile_center_ras, tile_center_decs, radius)]
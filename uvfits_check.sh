@@ -63,36 +63,5 @@ then
 fi
 ############End of check inputs
 
-#aws s3 ls command cannot use wildcards, hence this workaround  - 3/2018
-ls_output_filename_uvfits=( $(aws s3 ls ${s3_uvfits}/ | tr -s ' ' | cut -d' ' -f4) )
-ls_output_filename_metafits=( $(aws s3 ls ${s3_metafits}/ | tr -s ' ' | cut -d' ' -f4) )
-
-#Check that all uvfits are present, print if they are not
-unset miss_flag
-while read line
-do
-    if [[ "$(grep -o $line <<< ${ls_output_filename_uvfits[*]} | wc -l)" -eq 0 ]]
-    then
-        if [ -z ${miss_flag} ]
-        then
-            echo Some uvfits are missing:
-            miss_flag=1
-        fi
-        echo $line
-    fi
-done < $check_list
-
-#Check that all metafits are present, print if they are not
-unset miss_flag
-while read line
-do
-    if [[ "$(grep -o $line <<< ${ls_output_filename_metafits[*]} | wc -l)" -eq 0 ]]
-    then
-        if [ -z ${miss_flag} ]
-        then
-            echo Some metafits are missing:
-            miss_flag=1
-        fi
-        echo $line
-    fi
-done < $check_list
+#Index each listing once and check every obsid against it
+inventory_check.py -f ${check_list} -u ${s3_uvfits} -m ${s3_metafits}